@@ -0,0 +1,55 @@
+# beagle - scrape web resources for changes and notify users by email
+# Copyright (C) 2013  The Open Knowledge Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from binascii import hexlify, unhexlify
+
+class DigestSet(object):
+    """
+    Compact set of checksums (hexadecimal 128 bit digests). The digests are
+    stored as raw 16 byte strings instead of 32 character hexadecimal
+    strings, which halves the memory the checksums of a site take while
+    lookups stay as fast as in a set of the checksums.
+    """
+
+    __slots__ = ('digests',)
+
+    def __init__(self, checksums=()):
+        self.digests = set(unhexlify(checksum) for checksum in checksums)
+
+    def add(self, checksum):
+        """
+        Add a checksum to the set
+        """
+        self.digests.add(unhexlify(checksum))
+
+    def remove(self, checksum):
+        """
+        Remove a checksum from the set. Raises KeyError if it isn't in it
+        """
+        try:
+            self.digests.remove(unhexlify(checksum))
+        except KeyError:
+            raise KeyError(checksum)
+
+    def __contains__(self, checksum):
+        return unhexlify(checksum) in self.digests
+
+    def __iter__(self):
+        for digest in self.digests:
+            yield hexlify(digest)
+
+    def __len__(self):
+        return len(self.digests)
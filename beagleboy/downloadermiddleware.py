@@ -0,0 +1,213 @@
+# beagle - scrape web resources for changes and notify users by email
+# Copyright (C) 2013  The Open Knowledge Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from scrapy import signals, log
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.httpobj import urlparse_cached
+from beagleboy.signals import site_finished
+from beagleboy.validators import Validators, request_site
+
+class ConditionalRequestMiddleware(object):
+    """
+    Downloader middleware for conditional GET requests. The requests are
+    turned into conditional requests by the download handler (see
+    beagleboy.validators) since it can wait for the stored validators of a
+    site to be loaded. The middleware gives the spider its validators and
+    handles the 304 Not Modified responses
+    """
+
+    def __init__(self, settings):
+        """
+        Initialise the middleware. The validators are given to the spider
+        when it opens
+        """
+        self.settings = settings
+        self.validators = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        """
+        Create the middleware from a crawler. Raises NotConfigured if
+        conditional requests have been turned off in the settings
+        """
+
+        if not crawler.settings.getbool('CONDITIONAL_REQUESTS_ENABLED', True):
+            raise NotConfigured
+
+        middleware = cls(crawler.settings)
+        crawler.signals.connect(middleware.spider_opened,
+                                signal=signals.spider_opened)
+        crawler.signals.connect(middleware.spider_closed,
+                                signal=signals.spider_closed)
+        crawler.signals.connect(middleware.site_finished,
+                                signal=site_finished)
+        return middleware
+
+    def spider_opened(self, spider):
+        """
+        Give the spider the validators. They're loaded site by site as the
+        spider reaches them (the spider's outstanding requests tell us which
+        other sites to load along with them)
+        """
+        self.validators = Validators(self.settings,
+                                     getattr(spider, 'outstanding', {}))
+        spider.validators = self.validators
+
+    def spider_closed(self, spider):
+        """
+        Disconnect the database connection of the validators
+        """
+        return self.validators.disconnect()
+
+    def site_finished(self, site, spider):
+        """
+        Forget the validators of a site that has been crawled
+        """
+        self.validators.forget(site)
+
+    def process_response(self, request, response, spider):
+        """
+        If the server responds with 304 Not Modified for a site we add the
+        urls of the resources we know for that site to the request meta
+        since we cannot extract links from an empty body
+        """
+
+        if response.status == 304 and 'Referer' not in request.headers:
+            site = request_site(request)
+            request.meta['resources'] = [url for url in
+                                         self.validators.get(site)
+                                         if url != request.url]
+        return response
+
+class AdaptiveThrottleMiddleware(object):
+    """
+    Downloader middleware that adjusts the concurrency and delay of each
+    host (download slot) on the fly. It keeps a moving average of the
+    latency and error rate (server errors and failed downloads) for each
+    host. Healthy hosts (fast and few errors) get more concurrent requests
+    and a shorter delay while slow or failing hosts get fewer concurrent
+    requests and a longer delay, within configurable floors and ceilings.
+    """
+
+    def __init__(self, crawler):
+        """
+        Initialise the middleware with the ADAPTIVE_THROTTLE_* settings
+        """
+        self.crawler = crawler
+        settings = crawler.settings
+
+        self.min_concurrency = settings.getint(
+            'ADAPTIVE_THROTTLE_MIN_CONCURRENCY', 1)
+        self.max_concurrency = settings.getint(
+            'ADAPTIVE_THROTTLE_MAX_CONCURRENCY', 16)
+        self.min_delay = settings.getfloat('ADAPTIVE_THROTTLE_MIN_DELAY', 0.0)
+        self.max_delay = settings.getfloat('ADAPTIVE_THROTTLE_MAX_DELAY', 30.0)
+        # Hosts with a higher average latency (in seconds) or error rate are
+        # considered to be struggling
+        self.target_latency = settings.getfloat(
+            'ADAPTIVE_THROTTLE_TARGET_LATENCY', 2.0)
+        self.max_error_rate = settings.getfloat(
+            'ADAPTIVE_THROTTLE_MAX_ERROR_RATE', 0.2)
+        # Weight of the newest observation in the moving averages
+        self.smoothing = settings.getfloat('ADAPTIVE_THROTTLE_SMOOTHING', 0.3)
+        self.debug = settings.getbool('ADAPTIVE_THROTTLE_DEBUG')
+
+        # Moving averages of latency and error rate for each host
+        self.latency = {}
+        self.errors = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        """
+        Create the middleware from a crawler. Raises NotConfigured if the
+        adaptive throttling hasn't been enabled in the settings
+        """
+        if not crawler.settings.getbool('ADAPTIVE_THROTTLE_ENABLED'):
+            raise NotConfigured
+        return cls(crawler)
+
+    def _slot(self, request):
+        """
+        Get the download slot key and the download slot for a request
+        """
+        key = request.meta.get('download_slot') or \
+            urlparse_cached(request).hostname or ''
+        return key, self.crawler.engine.downloader.slots.get(key)
+
+    def _average(self, averages, key, value):
+        """
+        Update the moving average for a host with a new value
+        """
+        if key not in averages:
+            averages[key] = value
+        else:
+            averages[key] = self.smoothing * value + \
+                (1 - self.smoothing) * averages[key]
+        return averages[key]
+
+    def _adjust(self, request, latency, error):
+        """
+        Update the moving averages of the request's host and adjust the
+        concurrency and delay of its download slot
+        """
+
+        key, slot = self._slot(request)
+        if slot is None:
+            return
+
+        error_rate = self._average(self.errors, key, 1.0 if error else 0.0)
+        if latency is not None:
+            latency = self._average(self.latency, key, latency)
+        else:
+            latency = self.latency.get(key, 0.0)
+
+        (concurrency, delay) = (slot.concurrency, slot.delay)
+        if error_rate > self.max_error_rate or latency > self.target_latency:
+            # The host is struggling so we halve the concurrency and double
+            # the delay (or start with a delay of the average latency)
+            slot.concurrency = max(self.min_concurrency, slot.concurrency // 2)
+            slot.delay = min(self.max_delay,
+                             max(self.min_delay, slot.delay * 2 or latency))
+        elif error_rate <= self.max_error_rate / 2 and \
+                latency <= self.target_latency / 2:
+            # The host is healthy so we add a concurrent request and halve
+            # the delay (dropping it when it gets really small)
+            slot.concurrency = min(self.max_concurrency, slot.concurrency + 1)
+            slot.delay = max(self.min_delay,
+                             slot.delay / 2 if slot.delay > 0.05 else 0.0)
+
+        if self.debug and (concurrency, delay) != (slot.concurrency,
+                                                   slot.delay):
+            log.msg(format='Throttle %(slot)s: concurrency %(concurrency)d, '
+                    'delay %(delay).2fs (latency %(latency).2fs, '
+                    'errors %(errors).2f)', level=log.INFO, slot=key,
+                    concurrency=slot.concurrency, delay=slot.delay,
+                    latency=latency, errors=error_rate)
+
+    def process_response(self, request, response, spider):
+        """
+        Adjust the host's slot based on the latency and status of the
+        response (server errors and too many requests count as errors)
+        """
+        error = response.status >= 500 or response.status == 429
+        self._adjust(request, request.meta.get('download_latency'), error)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        """
+        Adjust the host's slot after a failed download (e.g. timeout)
+        """
+        self._adjust(request, request.meta.get('download_latency'), True)
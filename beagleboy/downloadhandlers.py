@@ -0,0 +1,204 @@
+# beagle - scrape web resources for changes and notify users by email
+# Copyright (C) 2013  The Open Knowledge Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from cStringIO import StringIO
+from hashlib import md5
+import zlib
+from twisted.internet import defer, protocol
+from twisted.web.http import PotentialDataLoss
+from scrapy.xlib.tx import ResponseDone
+from scrapy.core.downloader.handlers.http11 import HTTP11DownloadHandler, \
+    ScrapyAgent
+from scrapy.http import Headers, TextResponse
+from scrapy.responsetypes import responsetypes
+from scrapy import log
+
+# The headers used to fingerprint a resource that's too large to be hashed
+FINGERPRINT_HEADERS = ('Content-Length', 'Content-Type', 'ETag',
+                       'Last-Modified')
+
+def fingerprint(headers):
+    """
+    Create a checksum out of the response headers. This is used for
+    resources that are too large to be downloaded and hashed
+    """
+    values = [headers.get(h, '') for h in FINGERPRINT_HEADERS]
+    return md5('\n'.join(values)).hexdigest()
+
+class HashingDownloadHandler(HTTP11DownloadHandler):
+    """
+    HTTP 1.1 download handler that computes the checksum of non-text
+    resources (pdfs, swf files, spreadsheets etc.) as the body arrives
+    instead of holding the whole body in memory. Text responses (which we
+    need to extract links from) are kept in memory as usual.
+
+    Resources larger than DOWNLOAD_HASH_MAXSIZE are not downloaded (text
+    responses included), their checksum is created from the response
+    headers instead.
+
+    If snapshots are enabled non-text bodies up to SNAPSHOT_MAXSIZE are
+    also compressed as they arrive and put into the request meta under
+    'snapshot' (in case the resource has changed and should be stored).
+    """
+
+    def __init__(self, settings):
+        super(HashingDownloadHandler, self).__init__(settings)
+        self._maxsize = settings.getint('DOWNLOAD_HASH_MAXSIZE',
+                                        50 * 1024 * 1024)
+        self._snapshot_maxsize = 0
+        if settings.getbool('SNAPSHOTS_ENABLED'):
+            self._snapshot_maxsize = settings.getint('SNAPSHOT_MAXSIZE',
+                                                     4 * 1024 * 1024)
+
+    def download_request(self, request, spider):
+        """
+        Return a deferred for the HTTP download. If the spider has stored
+        validators (see beagleboy.validators) the download waits for the
+        validators of the request's site so it can be sent as a conditional
+        request
+        """
+        validators = getattr(spider, 'validators', None)
+        if validators is None:
+            return self._download(request)
+        return validators.conditional(request).addCallback(self._download)
+
+    def _download(self, request):
+        """
+        Download a request with the hashing agent
+        """
+        agent = HashingAgent(contextFactory=self._contextFactory,
+                             pool=self._pool, maxsize=self._maxsize,
+                             snapshot_maxsize=self._snapshot_maxsize)
+        return agent.download_request(request)
+
+class HashingAgent(ScrapyAgent):
+    """
+    Scrapy agent that delivers the response body to a hashing reader. The
+    checksum of non-text resources is put into the request meta under
+    'checksum' and the number of downloaded bytes under 'download_size'
+    """
+
+    def __init__(self, maxsize, snapshot_maxsize=0, *args, **kwargs):
+        super(HashingAgent, self).__init__(*args, **kwargs)
+        self._maxsize = maxsize
+        self._snapshot_maxsize = snapshot_maxsize
+
+    def _cb_bodyready(self, txresponse, request):
+        # A checksum might be left in the meta from a redirected request
+        request.meta.pop('checksum', None)
+        request.meta.pop('snapshot', None)
+        request.meta['download_size'] = 0
+
+        # deliverBody hangs for responses without body
+        if txresponse.length == 0:
+            return txresponse, '', None
+
+        # Pages are kept in memory since we need to extract links from them
+        headers = Headers(txresponse.headers.getAllRawHeaders())
+        respcls = responsetypes.from_args(headers=headers, url=request.url)
+        keep = issubclass(respcls, TextResponse)
+
+        def _cancel(_):
+            txresponse._transport._producer.loseConnection()
+
+        d = defer.Deferred(_cancel)
+        txresponse.deliverBody(_HashingResponseReader(
+                d, txresponse, request, headers, self._maxsize, keep,
+                self._snapshot_maxsize))
+        return d
+
+class _HashingResponseReader(protocol.Protocol):
+    """
+    Protocol that feeds the response body into a digest instead of a buffer
+    (unless the body should be kept) and stops the download if the body
+    gets larger than the maximum size. The body is also compressed for a
+    snapshot if it isn't larger than the snapshot maximum size.
+    """
+
+    def __init__(self, finished, txresponse, request, headers, maxsize,
+                 keep=False, snapshot_maxsize=0):
+        self._finished = finished
+        self._txresponse = txresponse
+        self._request = request
+        self._headers = headers
+        self._maxsize = maxsize
+        self._digest = None if keep else md5()
+        self._bodybuf = StringIO() if keep else None
+        self._size = 0
+        # Compressed chunks of the body (kept bodies are snapshotted later)
+        self._snapshot_maxsize = snapshot_maxsize
+        self._compressor = None
+        self._snapshot = None
+        if snapshot_maxsize and not keep:
+            self._compressor = zlib.compressobj()
+            self._snapshot = []
+
+    def _too_large(self):
+        """
+        Use the header fingerprint as the checksum and stop the download
+        """
+        log.msg(format='Resource %(url)s is larger than %(maxsize)d bytes, '
+                'using header fingerprint', level=log.DEBUG,
+                url=self._request.url, maxsize=self._maxsize)
+        self._request.meta['checksum'] = fingerprint(self._headers)
+        self._finished.callback((self._txresponse, '', ['fingerprint']))
+        self.transport.stopProducing()
+
+    def connectionMade(self):
+        # We don't even start downloading if the server tells us the
+        # resource is too large
+        length = self._txresponse.length
+        if isinstance(length, (int, long)) and length > self._maxsize:
+            self._too_large()
+
+    def dataReceived(self, bodyBytes):
+        if self._finished.called:
+            return
+
+        self._size += len(bodyBytes)
+        self._request.meta['download_size'] = self._size
+        if self._size > self._maxsize:
+            self._too_large()
+        elif self._bodybuf is not None:
+            self._bodybuf.write(bodyBytes)
+        else:
+            self._digest.update(bodyBytes)
+            if self._snapshot is not None:
+                if self._size > self._snapshot_maxsize:
+                    self._snapshot = None
+                else:
+                    self._snapshot.append(
+                        self._compressor.compress(bodyBytes))
+
+    def connectionLost(self, reason):
+        if self._finished.called:
+            return
+
+        if self._bodybuf is not None:
+            body = self._bodybuf.getvalue()
+        else:
+            body = ''
+            self._request.meta['checksum'] = self._digest.hexdigest()
+            if self._snapshot is not None:
+                self._snapshot.append(self._compressor.flush())
+                self._request.meta['snapshot'] = ''.join(self._snapshot)
+
+        if reason.check(ResponseDone):
+            self._finished.callback((self._txresponse, body, None))
+        elif reason.check(PotentialDataLoss):
+            self._finished.callback((self._txresponse, body, ['partial']))
+        else:
+            self._finished.errback(reason)
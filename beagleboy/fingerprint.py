@@ -0,0 +1,187 @@
+# beagle - scrape web resources for changes and notify users by email
+# Copyright (C) 2013  The Open Knowledge Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+from hashlib import md5
+from urlparse import urlparse
+from scrapy.http import TextResponse
+
+# Attributes whose values change on every request (tokens, nonces etc.)
+VOLATILE_ATTRIBUTES = (r'nonce', r'[\w-]*csrf[\w-]*', r'[\w-]*token[\w-]*',
+                       r'data-[\w-]*(?:time|date|stamp)[\w-]*')
+# Form fields whose values change on every request
+VOLATILE_FIELDS = (r'[\w-]*csrf[\w-]*', r'[\w-]*token[\w-]*', r'__viewstate',
+                   r'__eventvalidation', r'__requestdigest')
+# Query parameters used for cache busting and session ids in urls
+VOLATILE_PARAMETERS = (r'_', r'cb', r'rnd', r'rand', r'random', r'ts',
+                       r'timestamp', r'nocache', r'phpsessid', r'jsessionid',
+                       r'sid', r'sessionid')
+# Unix timestamps (seconds or milliseconds) assigned to something, e.g. in
+# scripts. Budget amounts look the same so this isn't removed by default but
+# it can be added to the ignore rules of hosts known to have them
+TIMESTAMPS = r'(?<=[=:("\'])\s*1\d{9}(?:\d{3})?\b'
+
+def hamming(a, b):
+    """
+    Count the bits that differ between two hexadecimal checksums
+    """
+    return bin(int(a, 16) ^ int(b, 16)).count('1')
+
+class Fingerprinter(object):
+    """
+    Compute the checksum of a response. This fingerprinter hashes the raw
+    body of the response (or uses the checksum computed while downloading).
+    Subclasses can override normalize() to remove noise from the body
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+
+    def normalize(self, response):
+        """
+        Return the body that should be hashed
+        """
+        return response.body
+
+    def checksum(self, response):
+        """
+        Get the checksum for a response
+        """
+
+        # Large resources are hashed while they're downloaded so the
+        # checksum might already be in the meta
+        if response.meta.get('checksum'):
+            return response.meta['checksum']
+
+        return md5(self.normalize(response)).hexdigest()
+
+class NormalizedFingerprinter(Fingerprinter):
+    """
+    Fingerprinter that removes noise from web pages and scripts before
+    they're hashed: comments, volatile attributes of tags (tokens and
+    nonces), cache busting query parameters and session ids in links and
+    whitespace (outside of preformatted text). Per host ignore rules (regular expressions) can be provided
+    with the FINGERPRINT_IGNORE setting, e.g.:
+
+        FINGERPRINT_IGNORE = {'www.ministry.gov': [r'Visitors: \d+',
+                                                   TIMESTAMPS]}
+    """
+
+    def __init__(self, settings):
+        super(NormalizedFingerprinter, self).__init__(settings)
+
+        attributes = '|'.join(settings.getlist('FINGERPRINT_VOLATILE_ATTRIBUTES',
+                                               VOLATILE_ATTRIBUTES))
+        fields = '|'.join(settings.getlist('FINGERPRINT_VOLATILE_FIELDS',
+                                           VOLATILE_FIELDS))
+        parameters = '|'.join(settings.getlist('FINGERPRINT_VOLATILE_PARAMETERS',
+                                               VOLATILE_PARAMETERS))
+
+        # Volatile attributes, links (whose cache busting query parameters
+        # and session ids are removed) and those parameters. These are only
+        # removed inside tags so the text of the page is left alone
+        self.attribute = re.compile(
+            r'\s(?:%s)\s*=\s*(?:"[^"]*"|\'[^\']*\'|[^\s>]+)' % attributes,
+            re.I)
+        self.link = re.compile(
+            r'(\s(?:href|src)\s*=\s*)("[^"]*"|\'[^\']*\'|[^\s>]+)', re.I)
+        self.parameter = re.compile(
+            r'([?&;])(?:%s)=[^&;#"\'\s>]*(?:&amp;|&)?' % parameters, re.I)
+
+        # The patterns are applied in this order and matches replaced with
+        # the replacement string (or what the replacement function returns)
+        self.patterns = [
+            # Comments (but not conditional comments for internet explorer)
+            (re.compile(r'<!--(?!\[if).*?-->', re.S), ''),
+            # Volatile attributes and parameters of links in tags
+            (re.compile(r'<[a-zA-Z][^>]*>'), self._tag),
+            # Values of volatile form fields
+            (re.compile(r'(<input[^>]+name\s*=\s*["\']?(?:%s)["\']?[^>]*?)'
+                        r'\svalue\s*=\s*(?:"[^"]*"|\'[^\']*\'|[^\s>]+)' % (
+                        fields), re.I), r'\1'),
+            # Whitespace (but not in preformatted text where it's content)
+            (re.compile(r'(<pre\b.*?</pre\s*>)|\s+', re.I | re.S),
+             lambda match: match.group(1) or ' ')
+            ]
+
+        # Compile the ignore rules for each host
+        self.ignore = {}
+        for host, rules in settings.get('FINGERPRINT_IGNORE', {}).iteritems():
+            self.ignore[host] = [re.compile(r, re.S) for r in rules]
+
+    def _tag(self, match):
+        """
+        Remove volatile attributes from a tag and cache busting parameters
+        and session ids from its links
+        """
+        tag = self.attribute.sub('', match.group(0))
+        return self.link.sub(lambda link: link.group(1) + self.parameter.sub(
+                r'\1', link.group(2)), tag)
+
+    def normalize(self, response):
+        """
+        Remove noise from text responses before they're hashed
+        """
+
+        if not isinstance(response, TextResponse):
+            return response.body
+
+        body = response.body
+        for rule in self.ignore.get(urlparse(response.url).hostname, []):
+            body = rule.sub('', body)
+        for pattern, replacement in self.patterns:
+            body = pattern.sub(replacement, body)
+
+        return body.strip()
+
+class SimHashFingerprinter(NormalizedFingerprinter):
+    """
+    Fingerprinter that computes a 128 bit SimHash of the normalized text
+    responses instead of an md5 digest. SimHashes of similar pages only
+    differ by a few bits so small changes can be ignored by setting
+    FINGERPRINT_SIMHASH_DISTANCE (the number of bits that may differ for
+    a page to be considered unchanged).
+    """
+
+    # Text responses are split into tokens (words or tags) and hashed as
+    # overlapping shingles of this many tokens
+    shingle = 3
+    tokens = re.compile(r'<[^>]*>|[^\s<]+')
+
+    def checksum(self, response):
+        """
+        Get the SimHash of a text response or the md5 digest of any other
+        response
+        """
+
+        if not isinstance(response, TextResponse) or \
+                response.meta.get('checksum'):
+            return super(SimHashFingerprinter, self).checksum(response)
+
+        tokens = self.tokens.findall(self.normalize(response))
+        weights = [0] * 128
+        for i in xrange(max(len(tokens) - self.shingle + 1, 1)):
+            feature = ' '.join(tokens[i:i + self.shingle])
+            value = int(md5(feature).hexdigest(), 16)
+            for bit in xrange(128):
+                weights[bit] += 1 if value & (1 << bit) else -1
+
+        simhash = 0
+        for bit, weight in enumerate(weights):
+            if weight > 0:
+                simhash |= 1 << bit
+
+        return '%032x' % simhash
@@ -27,3 +27,15 @@ class WebResource(Item):
     url = Field()
     # Checksum of the resource to check for changes
     checksum = Field()
+    # HTTP status of the response (304 means the resource hasn't changed)
+    status = Field()
+    # ETag and Last-Modified headers of the response, only set if they
+    # differ from the ones already stored for the resource
+    etag = Field()
+    last_modified = Field()
+    # Snapshot of the body (only with SNAPSHOTS_ENABLED): the digest (md5) of
+    # the raw body and either the body itself (pages) or the body compressed
+    # with zlib (resources hashed while they're downloaded)
+    digest = Field()
+    body = Field()
+    snapshot = Field()
@@ -0,0 +1,127 @@
+# beagle - scrape web resources for changes and notify users by email
+# Copyright (C) 2013  The Open Knowledge Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import posixpath
+import re
+from urlparse import urlparse
+from lxml import etree
+from scrapy.link import Link
+from scrapy.linkextractor import IGNORED_EXTENSIONS
+from scrapy.utils.response import get_base_url
+from scrapy.utils.url import urljoin_rfc
+
+# Urls in stylesheets and style attributes
+CSS_URL = re.compile(r'url\(\s*[\'"]?([^\'")]+?)[\'"]?\s*\)', re.I)
+# Target of a meta refresh, e.g. <meta http-equiv="refresh" content="0; url=x">
+REFRESH_URL = re.compile(r'^\s*\d*\s*[;,]?\s*url\s*=\s*[\'"]?([^\'"]+)', re.I)
+
+class ResourceLinkExtractor(object):
+    """
+    Link extractor built on lxml that extracts the resources a web page is
+    made of. It has the same tags, attrs, deny and deny_extensions semantics
+    as scrapy's SgmlLinkExtractor (urls in the given attributes of the given
+    tags are extracted unless they match one of the deny regular expressions
+    or end with one of the denied extensions, by default scrapy's ignored
+    extensions like images and stylesheets) but it also understands:
+
+    * srcset attributes (e.g. of img and source tags)
+    * link tags, but only stylesheets (other link tags like feeds or
+      canonical urls aren't resources of the page)
+    * urls in CSS, both in style tags and style attributes (if css is True)
+    * the target of meta refresh tags (if refresh is True)
+    """
+
+    def __init__(self, tags=('a', 'area'), attrs=('href',), deny=(),
+                 deny_extensions=None, css=True, refresh=True):
+        self.tags = tuple(tags)
+        self.attrs = set(attrs)
+        self.deny = [re.compile(d) for d in deny]
+        if deny_extensions is None:
+            deny_extensions = IGNORED_EXTENSIONS
+        self.deny_extensions = set('.' + e for e in deny_extensions)
+        self.css = css
+        self.refresh = refresh
+
+    def _urls(self, document):
+        """
+        Generate the (url, text) tuples found in a parsed document
+        """
+
+        for element in document.iter(*self.tags):
+            # Only stylesheets are resources of a page
+            if element.tag == 'link' and 'stylesheet' not in \
+                    (element.get('rel') or '').lower():
+                continue
+
+            for attr in self.attrs.intersection(element.keys()):
+                value = element.get(attr)
+                if attr == 'srcset':
+                    # Srcsets are comma separated urls with descriptors
+                    for candidate in value.split(','):
+                        if candidate.strip():
+                            yield candidate.split()[0], ''
+                else:
+                    text = ''.join(element.itertext()) \
+                        if element.tag == 'a' else ''
+                    yield value, text.strip()
+
+        if self.css:
+            for element in document.iter('style'):
+                for url in CSS_URL.findall(element.text or ''):
+                    yield url, ''
+            for element in document.xpath('//*[@style]'):
+                for url in CSS_URL.findall(element.get('style')):
+                    yield url, ''
+
+        if self.refresh:
+            for element in document.iter('meta'):
+                if (element.get('http-equiv') or '').lower() == 'refresh':
+                    match = REFRESH_URL.match(element.get('content') or '')
+                    if match:
+                        yield match.group(1), ''
+
+    def extract_links(self, response):
+        """
+        Extract the links of a response as a list of scrapy Link objects
+        """
+
+        parser = etree.HTMLParser(encoding=response.encoding)
+        document = etree.fromstring(response.body, parser=parser)
+        if document is None:
+            return []
+
+        base_url = get_base_url(response)
+        links = []
+        seen = set()
+        for (url, text) in self._urls(document):
+            url = url.strip()
+            if not url or url.startswith('#'):
+                continue
+
+            url = urljoin_rfc(base_url, url, response.encoding)
+            # We only want web resources (not javascript:, mailto: etc.)
+            if not url.startswith(('http://', 'https://')):
+                continue
+            if url in seen or any(d.search(url) for d in self.deny):
+                continue
+            extension = posixpath.splitext(urlparse(url).path)[1].lower()
+            if extension in self.deny_extensions:
+                continue
+
+            seen.add(url)
+            links.append(Link(url, text))
+
+        return links
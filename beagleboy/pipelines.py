@@ -15,21 +15,50 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import txmongo
 import datetime
+import itertools
+import zlib
 from collections import defaultdict
 from scrapy import log
-from beaglemail import sender, template
-from db.collections import Users, Checksums
-from twisted.internet import defer
+from beagleboy import signals
+from beagleboy.fingerprint import hamming
+from beagleboy.digests import DigestSet
+from db.collections import Snapshots
+from db.deferred import DeferredChecksums, DeferredCheckpoints, \
+    DeferredCrawls, DeferredCrawlRuns, DeferredSites
+from twisted.internet import defer, threads
+from twisted.python.failure import Failure
 
 class UpdateChecker(object):
     """
     Check site items for updates by comparing checksums to those in a
     MongoDB collection. Sends out emails to users assigned with the sites
     if there are any updates.
+
+    By default everything is written to the database when the spider
+    closes. In streaming mode (STREAMING_UPDATES) each site is finished as
+    soon as all of its requests have completed and finished sites are
+    written (and notified about) in batches of STREAMING_BUFFER_SIZE sites
+    so only the sites being crawled are kept in memory.
+
+    The database is accessed with txmongo (see db/deferred.py) so the crawl
+    goes on while we wait for it. Snapshots, the bulk writes of checksums
+    and notifications (which need pymongo and smtplib) are handled in
+    threads.
     """
 
+    @classmethod
+    def from_crawler(cls, crawler):
+        """
+        Create the pipeline and listen for finished sites if streaming
+        """
+        pipeline = cls()
+        if crawler.settings.getbool('STREAMING_UPDATES'):
+            crawler.signals.connect(pipeline.site_finished,
+                                    signal=signals.site_finished)
+        return pipeline
+
+    @defer.inlineCallbacks
     def open_spider(self, spider):
         """
         Called when the spider starts (but before it crawls). This method is
@@ -37,20 +66,274 @@ class UpdateChecker(object):
         accessing MongoDB.
         """
 
-        # We will need to hold all checksums and changes until the spider
-        # is closed (so we won't access the database for every item)
-        self.checksums = defaultdict(set)
+        # The collections share one (lazy) connection
+        settings = spider.crawler.settings
+        self.checksum_db = DeferredChecksums(settings)
+        connection = self.checksum_db.connection
+        self.checkpoint_db = DeferredCheckpoints(settings, connection)
+        self.crawl_db = DeferredCrawls(settings, connection)
+        self.run_db = DeferredCrawlRuns(settings, connection)
+        self.site_db = DeferredSites(settings, connection)
+
+        # Writes running in the background (the spider isn't closed before
+        # they're done) and whether any of them has failed
+        self.pending = set()
+        self.write_failed = False
+
+        # We will need to hold all checksums and changes until the sites are
+        # finished (so we won't access the database for every item). The
+        # checksums are stored compactly and loaded as the crawl reaches
+        # each site (in batches of CHECKSUM_LOAD_SITES sites)
+        self.checksums = defaultdict(DigestSet)
+        self.loaded = set()
+        # Sites being loaded with the Deferreds of the items waiting for them
+        self.loading = {}
+        self.load_size = spider.crawler.settings.getint('CHECKSUM_LOAD_SITES',
+                                                        50)
         self.changes = defaultdict(list)
+        # A rebaseline crawl stores the checksums of changed resources
+        # without treating them as changes (see REBASELINE in settings)
+        self.rebaseline = spider.crawler.settings.getbool('REBASELINE')
+        # Unchanged resources for which the server sent new ETag or
+        # Last-Modified values and resources with new checksums when
+        # rebaselining (these are stored but not notified about)
+        self.revalidations = defaultdict(list)
+        # All sites that have been crawled (to record their change history)
+        self.crawled = set()
+        # Urls that have been processed for each site (the same resource can
+        # be reached twice, e.g. through a redirect, or be restored from a
+        # checkpoint)
+        self.processed = defaultdict(set)
+        # Sites that have finished but haven't been written yet and sites
+        # that have finished while some of their items were being checked
+        # (with the number of items being checked for each site)
+        self.finished = set()
+        self.finishing = set()
+        self.checking = defaultdict(int)
+        self.buffer_size = spider.crawler.settings.getint(
+            'STREAMING_BUFFER_SIZE', 100)
+
+        # Snapshots of changed resources that haven't been written yet
+        # (written when the buffered snapshots get larger than
+        # SNAPSHOT_BUFFER_SIZE bytes or when the sites are written)
+        self.snapshots = []
+        self.snapshot_size = 0
+
+        # Checksums that differ by fewer bits than this are considered to be
+        # the same resource (only used with SimHash fingerprints)
+        self.distance = spider.crawler.settings.getint(
+            'FINGERPRINT_SIMHASH_DISTANCE', 0)
 
-        # Open up the database connection and update the checksums
-        with Checksums(spider.crawler.settings) as checksums:
-            self.checksums.update(checksums.all())
+        # When the crawl started (identifies the crawl telemetry if this
+        # isn't a crawl run)
+        self.started = datetime.datetime.now()
 
+        # Crawl runs (see crawler.py) checkpoint the processed items every
+        # CHECKPOINT_INTERVAL items so an interrupted run can be resumed
+        self.run = getattr(spider, 'run', None)
+        self.shard = getattr(spider, 'shard', 0)
+        self.interval = spider.crawler.settings.getint('CHECKPOINT_INTERVAL',
+                                                       100)
+        self.checkpoint = []
+
+        # If the run has been interrupted we replay the processed items so
+        # we end up in the same state as before
+        if self.run is not None:
+            items = yield self.checkpoint_db.items(self.run, self.shard)
+            for item in items:
+                yield self._check(item, spider)
+
+    def _loaded(self, site, spider):
+        """
+        Get a Deferred that fires when the stored checksums of a site have
+        been loaded. They're loaded along with the checksums of other sites
+        the spider is crawling right now (so we don't need a round trip for
+        each site)
+        """
+
+        if site not in self.loaded:
+            sites = [site] + list(itertools.islice(
+                    (s for s in getattr(spider, 'outstanding', {})
+                     if s != site and s not in self.loaded),
+                    self.load_size - 1))
+            self.loaded.update(sites)
+            for s in sites:
+                self.loading[s] = []
+            self.checksum_db.load(sites).addBoth(self._load, sites)
+
+        if site not in self.loading:
+            return defer.succeed(None)
+
+        waiting = defer.Deferred()
+        self.loading[site].append(waiting)
+        return waiting
+
+    def _load(self, result, sites):
+        """
+        Add the loaded checksums of sites and fire the Deferreds of the items
+        waiting for them (if loading failed the sites are loaded again for
+        the next item)
+        """
+
+        failed = isinstance(result, Failure)
+        if failed:
+            self.loaded.difference_update(sites)
+        else:
+            for (site, checksum) in result:
+                self.checksums[site].add(checksum)
+
+        for site in sites:
+            for waiting in self.loading.pop(site):
+                if failed:
+                    waiting.errback(result)
+                else:
+                    waiting.callback(None)
+
+    def _near_duplicate(self, site, checksum):
+        """
+        Find a stored checksum for the site that is within the SimHash
+        distance of the given checksum. Returns None if none is found
+        """
+
+        if not self.distance:
+            return None
+
+        # md5 digests of resources that aren't web pages are stored in the
+        # same set but they're so far apart from any SimHash they won't match
+        for stored in self.checksums.get(site, ()):
+            if hamming(stored, checksum) <= self.distance:
+                return stored
+        return None
+
+    @defer.inlineCallbacks
     def process_item(self, item, spider):
         """
         Process each crawled page/source and check if it has changes
         """
 
+        # Resources that have already been processed have been checked
+        # (e.g. start pages are fetched again to follow their links when an
+        # interrupted run is resumed)
+        if item['url'] in self.processed.get(item['site'], ()):
+            defer.returnValue(item)
+
+        yield self._check(item, spider)
+
+        # The body has either been snapshotted or isn't needed anymore
+        item.pop('body', None)
+        item.pop('snapshot', None)
+        if self.snapshot_size >= spider.crawler.settings.getint(
+                'SNAPSHOT_BUFFER_SIZE', 16 * 1024 * 1024):
+            self._background(self._write_snapshots(spider))
+
+        # Checkpoint the item and write the checkpoint to the database if
+        # enough items have been processed
+        if self.run is not None:
+            self.checkpoint.append(dict(item))
+            if len(self.checkpoint) >= self.interval:
+                yield self._write_checkpoint(spider)
+
+        defer.returnValue(item)
+
+    def _background(self, deferred):
+        """
+        Keep track of a write running in the background and log it if it
+        fails
+        """
+
+        self.pending.add(deferred)
+        def done(result):
+            self.pending.discard(deferred)
+            return result
+        def failed(failure):
+            self.write_failed = True
+            return failure
+        deferred.addBoth(done)
+        deferred.addErrback(failed)
+        deferred.addErrback(log.err, 'Writing to the database failed')
+        return deferred
+
+    def _snapshot(self, item):
+        """
+        Keep a snapshot of a changed resource (if it has a body, items
+        restored from a checkpoint don't)
+        """
+        if not item.get('snapshot') and not item.get('body'):
+            return
+
+        snapshot = item.get('snapshot') or zlib.compress(item['body'])
+        self.snapshots.append({'site': item['site'], 'url': item['url'],
+                               'digest': item['digest'],
+                               'snapshot': snapshot})
+        self.snapshot_size += len(snapshot)
+
+    def _write_snapshots(self, spider):
+        """
+        Write the buffered snapshots to the database (in a thread)
+        """
+
+        if not self.snapshots:
+            return defer.succeed(None)
+
+        def write(snapshots, settings):
+            with Snapshots(settings) as collection:
+                collection.add(snapshots, settings.getint('SNAPSHOT_HISTORY',
+                                                          10))
+
+        (snapshots, self.snapshots) = (self.snapshots, [])
+        self.snapshot_size = 0
+        return threads.deferToThread(write, snapshots,
+                                     spider.crawler.settings)
+
+    def _write_checkpoint(self, spider):
+        """
+        Write the checkpointed items to the database
+        """
+
+        if not self.checkpoint:
+            return defer.succeed(None)
+
+        (checkpoint, self.checkpoint) = (self.checkpoint, [])
+        return self.checkpoint_db.add(self.run, self.shard, checkpoint)
+
+    @defer.inlineCallbacks
+    def _check(self, item, spider):
+        """
+        Check if a crawled page/source has changes by comparing its checksum
+        to the stored checksums of its site (once they've been loaded)
+        """
+
+        site = item['site']
+        self.crawled.add(site)
+        self.processed[site].add(item['url'])
+
+        # The site can't be written until its items have been checked
+        self.checking[site] += 1
+        try:
+            yield self._loaded(site, spider)
+            self._compare(item)
+        finally:
+            self.checking[site] -= 1
+            if not self.checking[site]:
+                del self.checking[site]
+                if site in self.finishing:
+                    self.finishing.discard(site)
+                    self.site_finished(site, spider)
+
+    def _compare(self, item):
+        """
+        Compare the checksum of an item to the stored checksums of its site
+        and keep track of changes
+        """
+
+        # If the resource has only changed a little we treat it as unchanged
+        # and pretend it has the stored checksum
+        if item['checksum'] not in self.checksums.get(item['site'], ()):
+            near_duplicate = self._near_duplicate(item['site'],
+                                                  item['checksum'])
+            if near_duplicate:
+                item['checksum'] = near_duplicate
+
         try:
             # Try to get the checksum from the set
             checksum = self.checksums[item['site']].remove(item['checksum'])
@@ -58,59 +341,171 @@ class UpdateChecker(object):
             # this makes handling this later much easier
             if not self.checksums[item['site']]:
                 del self.checksums[item['site']]
+
+            # The resource is unchanged but if the server sent new values
+            # for conditional requests we want to store them
+            if 'etag' in item or 'last_modified' in item:
+                self.revalidations[item['site']].append({
+                        'url':item['url'], 'checksum': item['checksum'],
+                        'etag': item.get('etag'),
+                        'last_modified': item.get('last_modified')})
         except KeyError:
+            # A 304 Not Modified response means the resource is unchanged
+            # even if its checksum has already been removed from the set
+            # (another url of the site has the same content)
+            if item.get('status') == 304:
+                return
+
             # If there's a key error the checksum doesn't exist (either it's
             # a new site or the site has been modified)
             if item['checksum'] not in self.checksums[item['site']]:
+                change = {'url':item['url'], 'checksum': item['checksum'],
+                          'etag': item.get('etag'),
+                          'last_modified': item.get('last_modified')}
+
+                # When rebaselining the checksum is only stored
+                if self.rebaseline:
+                    self.revalidations[item['site']].append(change)
+                    return
+
                 # We add the site along with the url and the checksum to 
                 # our changes dictionary
-                self.changes[item['site']].append({
-                        'url':item['url'], 'checksum': item['checksum']})
+                self.changes[item['site']].append(change)
+                self._snapshot(item)
+
+    def site_finished(self, site, spider):
+        """
+        Called (in streaming mode) when all requests of a site have
+        completed. The site is written (in the background) when enough sites
+        have finished
+        """
 
-        return item
+        if site in self.checking:
+            self.finishing.add(site)
+            return
 
+        self.finished.add(site)
+        if len(self.finished) >= self.buffer_size:
+            self._background(self._write(spider, self.finished))
+            self.finished = set()
+
+    @defer.inlineCallbacks
     def close_spider(self, spider):
         """
-        Called when the spider closes (after the crawl). This goes through all
-        changes, additions, and removals updates the database and sends out an
+        Called when the spider closes (after the crawl). This writes all
+        sites that haven't been written yet (all sites unless streaming)
+        including sites that have checksums but weren't crawled
+        """
+
+        settings = spider.crawler.settings
+        try:
+            yield defer.DeferredList(list(self.pending))
+
+            # Sites with stored checksums (only of the sites the spider
+            # crawls if it has been given a list of sites) never reached
+            uncrawled = yield self.checksum_db.sites(getattr(spider, 'sites',
+                                                             None))
+            uncrawled = set(uncrawled).difference(self.loaded)
+
+            yield self._write(spider, uncrawled.union(
+                    self.checksums, self.crawled, self.changes,
+                    self.revalidations, self.processed, self.finished,
+                    self.finishing))
+
+            # Everything has been written so the crawl (or the shard of a
+            # crawl run) can be marked as finished (see crawler.py)
+            spider.completed = not self.write_failed
+
+            # Old snapshots are removed when the crawl (or the crawl run, see
+            # crawler.py) is done
+            if self.run is None and settings.getbool('SNAPSHOTS_ENABLED'):
+                def prune(settings):
+                    with Snapshots(settings) as snapshots:
+                        snapshots.prune(settings.getint('SNAPSHOT_RETENTION',
+                                                        90))
+                yield threads.deferToThread(prune, settings)
+        finally:
+            self.checksum_db.disconnect()
+
+    @defer.inlineCallbacks
+    def _write(self, spider, sites):
+        """
+        Go through all changes, additions, and removals of the given sites
+        (which are then forgotten), update the database and send out an
         email in case the sites have changes somehow
         """
-        
-        with Checksums(spider.crawler.settings) as checksums:
-            # Go through all changes and update the checksums
-            for site, urls in self.changes.iteritems():
+
+        settings = spider.crawler.settings
+
+        # Take the state of the sites out of the pipeline
+        changes = {site: self.changes.pop(site) for site in sites
+                   if site in self.changes}
+        revalidations = {site: self.revalidations.pop(site) for site in sites
+                         if site in self.revalidations}
+        stale = {site: self.checksums.pop(site) for site in sites
+                 if site in self.checksums}
+        # Sites that were never loaded had no items so none of their
+        # resources were accessible
+        unloaded = [site for site in sites if site not in self.loaded]
+        self.loaded.update(unloaded)
+        crawled = self.crawled.intersection(sites)
+        self.crawled.difference_update(crawled)
+        for site in sites:
+            self.processed.pop(site, None)
+
+        # Snapshots are written before the changes so they're there when
+        # users are notified
+        yield self._write_snapshots(spider)
+
+        # If this crawl is a shard of a larger crawl we store the changes for
+        # the run. We do that before we update the checksums since the
+        # changes would be lost if the job was interrupted in between (and
+        # the checkpoint must have all items of the sites that are written)
+        if self.run is not None:
+            yield self._write_checkpoint(spider)
+            yield self.crawl_db.add_changes(self.run, changes.keys())
+
+        # The checksums are written in batches of CHECKSUM_BATCH_SIZE
+        batch_size = settings.getint('CHECKSUM_BATCH_SIZE', 1000)
+
+        # Update the checksums of all changes along with the new conditional
+        # request values of unchanged resources
+        yield self.checksum_db.update_many((dict(url, site=site)
+                                            for updates in (changes,
+                                                            revalidations)
+                                            for site, urls in
+                                            updates.iteritems()
+                                            for url in urls), batch_size)
+
+        # Remove all checksums remaining in checksums dict because they are
+        # no longer accessible (not crawled)
+        yield self.checksum_db.remove_many(stale, batch_size)
+        yield self.checksum_db.remove_sites(unloaded, batch_size)
+
+        # Record the change history of the crawled sites (used to schedule
+        # when each site should be crawled next)
+        yield self.site_db.record(crawled, changes.keys())
+
+        # Write the telemetry of the crawled resources in one go
+        if settings.getbool('TELEMETRY_ENABLED', True):
+            for urls in changes.itervalues():
                 for url in urls:
-                    result = checksums.update(site, url['url'], url['checksum'])
-
-            # Remove all sites remaining in checksums dict because the are no
-            # longer accessible (not crawled)
-            for site, checksum_set in self.checksums.iteritems():
-                checksums.remove(site, list(checksum_set))
-
-        # We loop through the sites that have been changed to
-        # send emails to the user watching them and update its time.
-        # But first we create an emailer out of our settings
-        emailer = sender.Emailer(spider.settings)
-
-        with Users(spider.crawler.settings) as users:
-            for site in set(self.changes.keys()):
-                # Get the user that watches this dataset
-                for user in users.have_url(site):
-                    # Send an email to that user
-                    # Get plain and html content to send with the emailer
-                    # The scraper email uses docurl for the site url and 
-                    # appurl to show where the form is
-                    params = {'researcher':user['name'], 'docurl':site,
-                              'appurl':spider.settings.get('FORM_URL', '')}
-                
-                    # We set html to True because we want both plain 
-                    # and html versions
-                    (plain, html) = template.render('scraper.email', params,
-                                                    user.get('locale', None),
-                                                    html=True)
-
-                    emailer.send(user['email'], plain, html_content=html)
-
-                # Update the last_changed for that particular site in the user's
-                # list of sites
-                users.touch(site)
+                    spider.telemetry.changed(url['url'])
+
+            run = self.run or self.started.strftime('%Y-%m-%dT%H:%M:%S')
+            yield self.run_db.add(run, self.shard, spider.telemetry.pop(sites))
+
+        # Notifications for shards of a crawl run are sent when all shards
+        # have finished
+        if self.run is not None or not changes:
+            return
+
+        # Notify users watching the sites that have changed (this looks up
+        # the users and sends the emails in a thread). The reminders are
+        # imported here since they need redis (to queue the delivery) which
+        # crawls that never notify anyone shouldn't depend on
+        from reminder import change_notification
+        result = yield threads.deferToThread(change_notification,
+                                             changes.keys(), settings)
+        log.msg('Change notifications: %(queued)d emails queued' % result,
+                spider=spider)
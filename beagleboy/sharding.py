@@ -0,0 +1,62 @@
+# beagle - scrape web resources for changes and notify users by email
+# Copyright (C) 2013  The Open Knowledge Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+from hashlib import md5
+from urlparse import urlsplit
+
+class HashRing(object):
+    """
+    Consistent hash ring that assigns keys to shards. Each shard is placed
+    on the ring many times (replicas) so keys are spread evenly and only a
+    few keys move to a different shard when the number of shards changes
+    """
+
+    def __init__(self, shards, replicas=100):
+        self.shards = shards
+        self.ring = sorted((self._hash('%d-%d' % (shard, replica)), shard)
+                           for shard in xrange(shards)
+                           for replica in xrange(replicas))
+        self.positions = [position for (position, shard) in self.ring]
+
+    def _hash(self, key):
+        """
+        Get the position of a key on the ring
+        """
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return long(md5(key).hexdigest()[:16], 16)
+
+    def shard(self, key):
+        """
+        Get the shard for a key (the first shard after the key on the ring)
+        """
+        index = bisect.bisect(self.positions, self._hash(key))
+        return self.ring[index % len(self.ring)][1]
+
+def shard_urls(urls, shards):
+    """
+    Split urls into a list of url lists (one for each shard). The urls are
+    split by their host so all urls of the same host end up in the same
+    shard (and the per host crawl politeness is preserved)
+    """
+
+    ring = HashRing(shards)
+    split = [[] for shard in xrange(shards)]
+    for url in urls:
+        host = (urlsplit(url).hostname or '').lower()
+        split[ring.shard(host)].append(url)
+    return split
@@ -0,0 +1,25 @@
+# beagle - scrape web resources for changes and notify users by email
+# Copyright (C) 2013  The Open Knowledge Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Signals sent by beagleboy (in addition to the scrapy signals). They are
+sent and connected to with the crawler's signal manager, like scrapy's.
+"""
+
+# Sent by the spider when all requests of a site have completed (the site
+# and its resources have been crawled and all of its items processed).
+# Arguments: site, spider
+site_finished = object()
@@ -16,11 +16,17 @@
 
 from scrapy.http import Request, HtmlResponse
 from scrapy.contrib.spiders import CrawlSpider, Rule
-from scrapy.contrib.linkextractors.sgml import SgmlLinkExtractor
+from scrapy.utils.misc import load_object
 from beagleboy.items import WebResource
-from db.collections import Users
-from scrapy import log
+from beagleboy.linkextractors import ResourceLinkExtractor
+from beagleboy.telemetry import Telemetry
+from beagleboy.signals import site_finished
+from db.collections import Users, Checkpoints
+from scrapy import log, signals
+from collections import defaultdict
+from functools import partial
 from hashlib import md5
+import time
 
 class WebResourceSpider(CrawlSpider):
     """
@@ -32,17 +38,27 @@ class WebResourceSpider(CrawlSpider):
     # Launch the crawler using scrapy crawl webresources
     name = "webresources"
 
+    # Resources are requested conditionally so we need to handle 304 Not
+    # Modified responses (which would otherwise be filtered out)
+    handle_httpstatus_list = [304]
+
     # We define what links we should follow and that we only go "one down".
     # So we'll only look at the web page and the content of its links (not the
     # links of the links etc.
+    # Besides links, frames, objects and scripts we follow the resources the
+    # page is made of (stylesheets, images, urls in css and meta refreshes)
+    # since budget documents are sometimes served that way. Like scrapy's
+    # link extractor we skip urls with extensions of images, stylesheets,
+    # media etc. so those aren't tracked as budget documents.
     # Since WordPress sites link back to an ever changing wordpress.org site
     # we don't follow those links. This is hardcoded since no other constantly
     # changing sites are known. If there are others we will have to fish this
     # out, and read from database (which can be set via a user interface).
     rules = [
-        Rule(SgmlLinkExtractor(
-                tags=('a', 'iframe', 'object', 'embed', 'script'),
-                attrs=('href', 'src', 'data'),
+        Rule(ResourceLinkExtractor(
+                tags=('a', 'iframe', 'object', 'embed', 'script', 'link',
+                      'img', 'source'),
+                attrs=('href', 'src', 'data', 'srcset'),
                 deny=('http://wordpress.org', )),
              callback='parse_start_url', follow=False)
         ]
@@ -50,16 +66,31 @@ class WebResourceSpider(CrawlSpider):
     @property
     def start_urls(self):
         """
-        Get the start_urls for the spider. These are fetched from a
-        database using get_user_urls()
+        Get the start_urls for the spider. These are the sites the spider has
+        been given (sites argument, e.g. when the crawl is split into shards)
+        or they are fetched from a database using get_user_urls()
         """
-        # Begin by creating our database user object (synchronous is ok here)
-        with Users(self.crawler.settings) as users:
-            # Then we return the urls of all users
-            urls = users.urls()
-            # We have now seen these urls so we don't have to crawl them again
-            self.seen = set([s.rstrip('/') for s in urls])
-            return urls
+        urls = getattr(self, 'sites', None)
+        if urls is None:
+            # Begin by creating our database user object (synchronous is ok)
+            with Users(self.crawler.settings) as users:
+                # Then we return the urls of all users
+                urls = users.urls()
+
+        # We have now seen these urls so we don't have to crawl them again
+        settings = self.crawler.settings
+        self.seen = load_object(settings.get('SEEN_STORE')).from_settings(
+            settings)
+        self.seen.update(urls)
+
+        # If this crawl run has been interrupted we don't fetch resources
+        # that have already been processed again
+        if getattr(self, 'run', None) is not None:
+            with Checkpoints(settings) as checkpoints:
+                self.seen.update(checkpoints.urls(self.run,
+                                                  getattr(self, 'shard', 0)))
+
+        return urls
 
     @start_urls.setter
     def start_urls(self, value):
@@ -69,27 +100,164 @@ class WebResourceSpider(CrawlSpider):
         """
         pass
 
+    @property
+    def fingerprinter(self):
+        """
+        Get the fingerprinter used to compute the checksums of responses.
+        The fingerprinter class is set with the FINGERPRINTER setting
+        """
+        if not hasattr(self, '_fingerprinter'):
+            settings = self.crawler.settings
+            fingerprinter = load_object(settings.get('FINGERPRINTER'))
+            self._fingerprinter = fingerprinter(settings)
+        return self._fingerprinter
+
+    @property
+    def telemetry(self):
+        """
+        Get the telemetry collector for the crawl (the pipeline writes the
+        telemetry to the database when it writes the sites)
+        """
+        if not hasattr(self, '_telemetry'):
+            self._telemetry = Telemetry()
+        return self._telemetry
+
+    def set_crawler(self, crawler):
+        """
+        Set the crawler and count the requests of the sites as they're
+        scheduled (see _scheduled)
+        """
+        super(WebResourceSpider, self).set_crawler(crawler)
+        crawler.signals.connect(self._scheduled,
+                                signal=signals.request_scheduled)
+
+    @property
+    def outstanding(self):
+        """
+        Get the number of scheduled requests of each site that haven't
+        completed yet (used to tell when a site has been completely crawled)
+        """
+        if not hasattr(self, '_outstanding'):
+            self._outstanding = defaultdict(int)
+        return self._outstanding
+
+    def _site(self, response):
+        """
+        Get the site (main page url) of a response. This is the Referer (set
+        by the OriginRefererMiddleware) or the original url in case of
+        redirects
+        """
+        site = response.request.meta.get('redirect_urls', [response.url])[0]
+        return response.request.headers.get('Referer', site)
+
+    def _request(self, site, url, **kwargs):
+        """
+        Create a request for a site (or for the site itself if site is None).
+        The requests aren't filtered by scrapy since the seen store already
+        filters the links (scrapy would silently drop redirects to already
+        crawled urls and the site would never be finished)
+        """
+        request = Request(url=url, dont_filter=True, **kwargs)
+        # A site is known by the (escaped) url scrapy really requests since
+        # that's what we get back from its response (see _site)
+        site = site or request.url
+        request.meta['site'] = site
+        request.errback = partial(self._failed, site, request.url)
+        return request
+
+    def _scheduled(self, request, spider):
+        """
+        Count a request of a site as outstanding once it has been scheduled
+        until its response has been parsed or it has failed. Requests dropped
+        by spider middlewares are never scheduled so they're never counted.
+        Retries and redirects are scheduled again but only counted once
+        """
+        site = request.meta.get('site')
+        if spider is not self or site is None or request.meta.get('counted'):
+            return
+        request.meta['counted'] = True
+        self.outstanding[site] += 1
+
+    def _completed(self, site):
+        """
+        Mark a request of a site as completed and send the site_finished
+        signal if it was the last one
+        """
+        self.outstanding[site] -= 1
+        if self.outstanding[site] <= 0:
+            del self.outstanding[site]
+            self.crawler.signals.send_catch_log(signal=site_finished,
+                                                site=site, spider=self)
+
+    def _failed(self, site, url, failure):
+        """
+        Errback for requests that failed (download errors, http errors etc.).
+        The failure is recorded in the telemetry since these responses never
+        reach the callback
+        """
+        self.telemetry.failed(site, url, failure)
+        self._completed(site)
+
+    def make_requests_from_url(self, url):
+        """
+        Create the request for a start url (the site itself)
+        """
+        # The callback is what scrapy would use anyway but scrapy refuses
+        # requests with an errback and no callback, which would break the
+        # copies redirects and retries make of the start requests
+        return self._request(None, url, callback=self.parse)
+
+    def _parse_response(self, response, callback, cb_kwargs, follow=True):
+        """
+        Parse a response (the items and requests are yielded by the
+        CrawlSpider) and mark its request as completed once all items and
+        requests have been yielded (so all items have been processed)
+        """
+        site = self._site(response)
+        try:
+            for output in super(WebResourceSpider, self)._parse_response(
+                    response, callback, cb_kwargs, follow):
+                yield output
+        finally:
+            self._completed(site)
+
     def _requests_to_follow(self, response):
         """
         Overwritten _requests_to_follow since we want to use a global seen
         and not a new one everytime so we won't follow the same urls again
         """
 
+        # If the site hasn't been modified we can't extract links from it
+        # (there's no body) so we follow the resources we already know of
+        if response.status == 304:
+            urls = [u for u in response.meta.get('resources', [])
+                    if self.seen.add(u)]
+            self.telemetry.links(response.url, len(urls))
+            site = self._site(response)
+            for url in urls:
+                r = self._request(site, url,
+                                  callback=self._response_downloaded)
+                r.meta.update(rule=0, link_text='')
+                yield self._rules[0].process_request(r)
+            return
+
         if not isinstance(response, HtmlResponse):
             return
 
+        site = self._site(response)
         for n, rule in enumerate(self._rules):
-            # We only add links which have never been seen
-            # We need to rstrip / because we don't know if the links have
-            # a trailing slash
+            # We only add links which have never been seen. Adding a url to
+            # the seen store tells us if it was already there (urls are
+            # canonicalized by the store so we catch different versions of
+            # the same url)
             links = [l for l in rule.link_extractor.extract_links(response)\
-                         if l.url.rstrip('/') not in self.seen]
+                         if self.seen.add(l.url)]
             if links and rule.process_links:
                 links = rule.process_links(links)
-            # Update self.seen - we add the url only (remove trailing slash)
-            self.seen = self.seen.union([l.url.rstrip('/') for l in links])
+            self.telemetry.links(response.url, len(links))
             for link in links:
-                r = Request(url=link.url, callback=self._response_downloaded)
+                r = self._request(site, link.url,
+                                  callback=self._response_downloaded)
                 r.meta.update(rule=n, link_text=link.text)
                 yield rule.process_request(r)
         
@@ -102,15 +270,51 @@ class WebResourceSpider(CrawlSpider):
         """
 
         item = WebResource()
-        # Get the main page url
-        site = response.request.meta.get('redirect_urls', [response.url])[0]
         # Set the main page url (either in request header under Referer or
-        # in the site variable)
-        item['site'] = response.request.headers.get('Referer', site)
+        # the original url of the request)
+        item['site'] = self._site(response)
         # URL of this resource (if this is a start_url this will be the same
         # url as in item['site'])
         item['url'] = response.url
-        # Get the checksum for the body
-        item['checksum'] = md5(response.body).hexdigest()
+        item['status'] = response.status
+
+        # The values we have stored for this resource (if any)
+        cached = response.meta.get('cached', {})
+
+        # If the resource hasn't been modified we reuse the stored checksum
+        # since the response has no body to compute it from
+        if response.status == 304:
+            item['checksum'] = cached['checksum']
+            self.telemetry.record(item['site'], response, 0.0)
+            return item
+
+        # Get the checksum for the body (noise is removed by the fingerprinter
+        # so we won't see changes to e.g. timestamps or session ids)
+        started = time.time()
+        item['checksum'] = self.fingerprinter.checksum(response)
+        self.telemetry.record(item['site'], response, time.time() - started)
+
+        # Only pass on the ETag and Last-Modified values if they differ from
+        # the ones we have stored (so they can be updated)
+        etag = response.headers.get('ETag')
+        if etag and etag != cached.get('etag'):
+            item['etag'] = etag
+        last_modified = response.headers.get('Last-Modified')
+        if last_modified and last_modified != cached.get('last_modified'):
+            item['last_modified'] = last_modified
+
+        # Pass on the body so the pipeline can store a snapshot if the
+        # resource has changed (resources hashed while downloading have been
+        # compressed already)
+        settings = self.crawler.settings
+        if settings.getbool('SNAPSHOTS_ENABLED'):
+            maxsize = settings.getint('SNAPSHOT_MAXSIZE', 4 * 1024 * 1024)
+            if response.meta.get('snapshot') is not None:
+                item['digest'] = response.meta['checksum']
+                item['snapshot'] = response.meta['snapshot']
+            elif response.body and len(response.body) <= maxsize and \
+                    'fingerprint' not in response.flags:
+                item['digest'] = md5(response.body).hexdigest()
+                item['body'] = response.body
 
         return item
@@ -0,0 +1,98 @@
+# beagle - scrape web resources for changes and notify users by email
+# Copyright (C) 2013  The Open Knowledge Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from urlparse import urlsplit
+
+class Telemetry(object):
+    """
+    Collects telemetry for each crawled resource: fetch latency, size,
+    status, number of redirects, number of extracted links, time it took
+    to compute the checksum and whether the resource had changed. The
+    spider and the pipeline record into the same collector (the spider's)
+    and the pipeline writes it to the database when the sites are written
+    (when the crawl ends or, in streaming mode, as the sites finish).
+    """
+
+    def __init__(self):
+        self.resources = {}
+
+    def _resource(self, url):
+        """
+        Get the telemetry record for a url (created if it doesn't exist)
+        """
+        if url not in self.resources:
+            self.resources[url] = {'url': url,
+                                   'host': urlsplit(url).hostname or '',
+                                   'links': 0, 'changed': False}
+        return self.resources[url]
+
+    def record(self, site, response, hash_time):
+        """
+        Record the telemetry of a downloaded response. The size is taken
+        from the download handler (resources can be hashed while they're
+        downloaded so the body might be empty)
+        """
+        resource = self._resource(response.url)
+        resource.update({
+                'site': site,
+                'status': response.status,
+                'latency': response.meta.get('download_latency'),
+                'bytes': response.meta.get('download_size',
+                                           len(response.body)),
+                'redirects': len(response.meta.get('redirect_urls', [])),
+                'hash_time': hash_time})
+
+    def failed(self, site, url, failure):
+        """
+        Record a request that failed. Http errors (e.g. 404 or 500) have a
+        response which is recorded with its status, other failures (e.g.
+        timeouts or refused connections) are recorded with the error
+        """
+        response = getattr(failure.value, 'response', None)
+        if response is not None:
+            self.record(site, response, 0.0)
+            return
+
+        resource = self._resource(url)
+        resource.update({'site': site, 'status': None,
+                         'error': failure.getErrorMessage()})
+
+    def links(self, url, count):
+        """
+        Record the number of links extracted from a resource
+        """
+        self._resource(url)['links'] += count
+
+    def changed(self, url):
+        """
+        Record that a resource has changed
+        """
+        self._resource(url)['changed'] = True
+
+    def pop(self, sites):
+        """
+        Remove and return the telemetry of the resources of the given sites
+        """
+        sites = set(sites)
+        urls = [url for (url, resource) in self.resources.iteritems()
+                if resource.get('site') in sites]
+        return [self.resources.pop(url) for url in urls]
+
+    def __iter__(self):
+        return self.resources.itervalues()
+
+    def __len__(self):
+        return len(self.resources)
@@ -0,0 +1,184 @@
+# beagle - scrape web resources for changes and notify users by email
+# Copyright (C) 2013  The Open Knowledge Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import math
+import re
+import struct
+from hashlib import md5
+from urllib import urlencode
+from urlparse import urlsplit, urlunsplit, parse_qsl
+
+# Query parameters used for tracking visitors, they don't change the content
+TRACKING_PARAMETERS = (r'utm_\w+', r'gclid', r'fbclid', r'msclkid', r'yclid',
+                       r'_ga', r'mc_cid', r'mc_eid')
+
+# Compiled pattern for the default parameters to remove
+TRACKING = re.compile('^(?:%s)$' % '|'.join(TRACKING_PARAMETERS), re.I)
+
+# Ports we remove from urls since they're the default for the scheme
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+def canonicalize(url, ignore=TRACKING):
+    """
+    Create a canonical version of a url so different urls for the same
+    resource can be detected. Scheme and host are lowercased, default ports,
+    fragments, trailing slashes and tracking parameters are removed and the
+    query parameters are sorted. The ignore parameter is a compiled regular
+    expression for query parameters that should be removed.
+    """
+
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+
+    # Lowercase the host (IPv6 addresses need their brackets back) and
+    # remove the port if it's the default one. If the port is malformed we
+    # just lowercase the netloc as it is
+    try:
+        port = parts.port
+    except ValueError:
+        netloc = parts.netloc.lower()
+    else:
+        netloc = (parts.hostname or '').rstrip('.')
+        if ':' in netloc:
+            netloc = '[%s]' % netloc
+        if port and port != DEFAULT_PORTS.get(scheme):
+            netloc = '%s:%d' % (netloc, port)
+        if parts.username:
+            userinfo = parts.username
+            if parts.password is not None:
+                userinfo = '%s:%s' % (userinfo, parts.password)
+            netloc = '%s@%s' % (userinfo, netloc)
+
+    # Keep blank values but remove ignored parameters and sort the rest
+    # (urlencode can't handle non-ascii unicode so we encode it as utf-8)
+    query = sorted((_utf8(k), _utf8(v)) for (k, v) in
+                   parse_qsl(parts.query, keep_blank_values=True)
+                   if not ignore.match(k))
+
+    return urlunsplit((scheme, netloc, parts.path.rstrip('/'),
+                       urlencode(query), ''))
+
+def _utf8(value):
+    """
+    Encode unicode values as utf-8 (other values are returned as they are)
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+class SeenUrls(object):
+    """
+    Store for the urls the spider has seen. Urls are canonicalized before
+    they're stored so the same resource won't be crawled twice
+    """
+
+    def __init__(self, ignore=TRACKING_PARAMETERS):
+        self.ignore = re.compile('^(?:%s)$' % '|'.join(ignore), re.I)
+        self.urls = set()
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings.getlist('CANONICAL_IGNORE_PARAMETERS',
+                                    TRACKING_PARAMETERS))
+
+    def _key(self, url):
+        """
+        Get the key to store for a url
+        """
+        return canonicalize(url, self.ignore)
+
+    def __contains__(self, url):
+        return self._key(url) in self.urls
+
+    def __len__(self):
+        return len(self.urls)
+
+    def add(self, url):
+        """
+        Add a url to the store. Returns True if the url hadn't been seen
+        before and False if it had
+        """
+        key = self._key(url)
+        if key in self.urls:
+            return False
+        self.urls.add(key)
+        return True
+
+    def update(self, urls):
+        """
+        Add many urls to the store
+        """
+        for url in urls:
+            self.add(url)
+
+class BloomSeenUrls(SeenUrls):
+    """
+    Compact store for the urls the spider has seen, backed by a Bloom filter.
+    It uses a fraction of the memory a set does for very large crawls but
+    it can claim (with a probability of error_rate) that an unseen url has
+    been seen, so that resource would not be crawled.
+    """
+
+    def __init__(self, capacity=1000000, error_rate=0.001,
+                 ignore=TRACKING_PARAMETERS):
+        super(BloomSeenUrls, self).__init__(ignore)
+        self.urls = None
+        self.count = 0
+
+        # Compute the optimal number of bits and hash functions
+        self.size = int(math.ceil(-capacity * math.log(error_rate) /
+                                  math.log(2) ** 2))
+        self.hashes = max(int(round(self.size * math.log(2) / capacity)), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings.getint('SEEN_BLOOM_CAPACITY', 1000000),
+                   settings.getfloat('SEEN_BLOOM_ERROR_RATE', 0.001),
+                   settings.getlist('CANONICAL_IGNORE_PARAMETERS',
+                                    TRACKING_PARAMETERS))
+
+    def _positions(self, url):
+        """
+        Get the bit positions for a url. We use double hashing to create all
+        of the hash functions out of the two halves of an md5 digest
+        """
+        key = self._key(url)
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        (a, b) = struct.unpack('<QQ', md5(key).digest())
+        return [(a + i * b) % self.size for i in xrange(self.hashes)]
+
+    def __contains__(self, url):
+        return all(self.bits[p >> 3] & (1 << (p & 7))
+                   for p in self._positions(url))
+
+    def __len__(self):
+        return self.count
+
+    def add(self, url):
+        """
+        Add a url to the store. Returns True if the url hadn't been seen
+        before and False if it had (or if it's a false positive)
+        """
+        new = False
+        for p in self._positions(url):
+            if not self.bits[p >> 3] & (1 << (p & 7)):
+                self.bits[p >> 3] |= 1 << (p & 7)
+                new = True
+        if new:
+            self.count += 1
+        return new
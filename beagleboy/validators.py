@@ -0,0 +1,128 @@
+# beagle - scrape web resources for changes and notify users by email
+# Copyright (C) 2013  The Open Knowledge Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import itertools
+from twisted.internet import defer
+from twisted.python.failure import Failure
+from scrapy import log
+from db.deferred import DeferredChecksums
+
+def request_site(request):
+    """
+    Get the site a request belongs to. This is the Referer (set by the
+    OriginRefererMiddleware) or the original url in case of redirects
+    """
+    url = request.meta.get('redirect_urls', [request.url])[0]
+    return request.headers.get('Referer', url)
+
+class Validators(object):
+    """
+    The stored checksum, ETag and Last-Modified values of the resources of
+    each site (used for conditional requests). They're loaded from the
+    database without blocking when the first request of a site is about to
+    be downloaded, along with those of other sites the spider is crawling
+    right now (like the pipeline loads checksums), and they're forgotten
+    when the site has been finished so we only hold the validators of the
+    sites being crawled.
+    """
+
+    def __init__(self, settings, outstanding):
+        self.checksum_db = DeferredChecksums(settings)
+        self.load_size = settings.getint('CHECKSUM_LOAD_SITES', 50)
+        # The number of outstanding requests of each site (the spider's)
+        self.outstanding = outstanding
+        self.sites = {}
+        self.loading = {}
+
+    def get(self, site):
+        """
+        Get the loaded validators of a site (a dictionary of resource urls
+        and their stored values)
+        """
+        return self.sites.get(site, {})
+
+    def forget(self, site):
+        """
+        Drop the validators of a site that has been finished
+        """
+        self.sites.pop(site, None)
+
+    def disconnect(self):
+        """
+        Disconnect the database connection
+        """
+        return self.checksum_db.disconnect()
+
+    def _loaded(self, site):
+        """
+        Get a Deferred that fires when the validators of a site have been
+        loaded
+        """
+
+        if site not in self.sites and site not in self.loading:
+            sites = [site] + list(itertools.islice(
+                    (s for s in self.outstanding if s != site and
+                     s not in self.sites and s not in self.loading),
+                    self.load_size - 1))
+            for s in sites:
+                self.loading[s] = []
+            self.checksum_db.validators(sites).addBoth(self._load, sites)
+
+        if site not in self.loading:
+            return defer.succeed(None)
+
+        waiting = defer.Deferred()
+        self.loading[site].append(waiting)
+        return waiting
+
+    def _load(self, result, sites):
+        """
+        Add the loaded validators of sites and fire the Deferreds of the
+        requests waiting for them. If loading failed the requests are sent
+        without conditional headers (they'll just be downloaded again)
+        """
+
+        if isinstance(result, Failure):
+            log.err(result, 'Loading the validators failed')
+            result = {}
+
+        for site in sites:
+            self.sites[site] = result.get(site, {})
+            for waiting in self.loading.pop(site):
+                waiting.callback(None)
+
+    def conditional(self, request):
+        """
+        Get a Deferred that fires with the request once the validators of
+        its site have been loaded. If we have seen the resource before the
+        stored values are put into the request meta (under 'cached') so the
+        spider can reuse the stored checksum if the server responds with
+        304 Not Modified and the conditional headers are added
+        """
+
+        def add(result):
+            cached = self.get(request_site(request)).get(request.url)
+            if cached:
+                request.meta['cached'] = cached
+                if cached.get('etag'):
+                    request.headers.setdefault('If-None-Match',
+                                               cached['etag'])
+                if cached.get('last_modified'):
+                    request.headers.setdefault('If-Modified-Since',
+                                               cached['last_modified'])
+            return request
+
+        return self._loaded(request_site(request)).addCallback(add)
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+# beagle - scrape web resources for changes and notify users by email
+# Copyright (C) 2013  The Open Knowledge Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+import Queue
+from beaglemail.sender import Emailer
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket that limits how many emails are sent per second
+    (across all connections). A rate of 0 means there's no limit.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token from the bucket, waiting until there is one
+        """
+
+        if not self.rate:
+            return
+
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class Dispatcher(object):
+    """
+    Sends emails over a number of concurrent connections to the mail server
+    (MAIL_CONNECTIONS) without going over MAIL_RATE emails per second in
+    total. Emails are put on a queue and sent by a thread per connection so
+    a slow reply from the mail server only holds up one connection. It has
+    the same send method as the Emailer and has to be used as a context
+    manager (all emails have been sent when the with statement is done):
+
+    with Dispatcher(settingsobject) as dispatcher:
+      # send many emails with dispatcher.send
+
+    The number of sent and failed emails are in sent and failed afterwards
+    (the keys of the delivered emails are in delivered and the keys of the
+    failed emails along with the errors in failures).
+    """
+
+    def __init__(self, settings, *args, **kwargs):
+        """
+        Initialize the dispatcher using a settings object that provides the
+        same interface as scrapy.settings.CrawlerSettings (the emailers of
+        the connections get the same settings)
+        """
+
+        self.settings = settings
+        self.connections = max(settings.getint('MAIL_CONNECTIONS', 4), 1)
+        self.bucket = TokenBucket(settings.getfloat('MAIL_RATE', 0),
+                                  self.connections)
+
+        # The queue is bounded so rendering doesn't run far ahead of sending
+        self.queue = Queue.Queue(self.connections * 10)
+        self.threads = []
+
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+        self.delivered = []
+        self.failures = []
+
+    def __enter__(self):
+        """
+        Start a thread for each connection
+        """
+
+        # Create the emailers here so bad settings raise right away
+        emailers = [Emailer(self.settings) for n in xrange(self.connections)]
+        self.threads = [threading.Thread(target=self._work, args=(emailer,))
+                        for emailer in emailers]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        """
+        Wait until all emails have been sent and stop the threads
+        """
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def send(self, to, content, html_content=None, key=None):
+        """
+        Queue an email to a recipient (same arguments as Emailer.send). The
+        key identifies the email in delivered and failures (it defaults to
+        the recipient)
+        """
+        if not self.threads:
+            raise RuntimeError('Dispatcher must be used in a with statement')
+        self.queue.put((to if key is None else key,
+                        (to, content, html_content)))
+
+    def flush(self):
+        """
+        Wait until all queued emails have been sent and return the keys of
+        the delivered emails and the failures since the last flush
+        """
+        self.queue.join()
+        with self.lock:
+            (delivered, failures) = (self.delivered, self.failures)
+            (self.delivered, self.failures) = ([], [])
+        return (delivered, failures)
+
+    def _work(self, emailer):
+        """
+        Send the queued emails over one connection until told to stop
+        """
+
+        with emailer:
+            while True:
+                message = self.queue.get()
+                if message is None:
+                    self.queue.task_done()
+                    return
+
+                (key, email) = message
+                self.bucket.acquire()
+                try:
+                    emailer.send(*email)
+                except Exception as error:
+                    # One email shouldn't stop the rest from being sent
+                    with self.lock:
+                        self.failed += 1
+                        self.failures.append((key, error))
+                else:
+                    with self.lock:
+                        self.sent += 1
+                        self.delivered.append(key)
+                finally:
+                    self.queue.task_done()
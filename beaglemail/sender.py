@@ -16,6 +16,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import smtplib
+import socket
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
@@ -23,6 +24,15 @@ class Emailer(object):
     """"
     Emailer object that sends emails using python's built-in smtplib. The
     emails can be either plain text only or both plain text and html
+
+    When used as a context manager the connection to the mail server is
+    kept open and reused for many emails (it's reopened after
+    MAIL_MESSAGES_PER_CONNECTION emails or if the server drops it):
+
+    with Emailer(settingsobject) as emailer:
+      # send many emails with emailer.send
+
+    Otherwise a connection is opened and closed for every email.
     """
 
     def __init__(self, settings, *args, **kwargs):
@@ -47,6 +57,64 @@ class Emailer(object):
         self.user = settings.get('MAIL_USER', None)
         self.password = settings.get('MAIL_PASS', None)
 
+        # Upgrade the connection with STARTTLS, how many emails are sent
+        # before reconnecting and the socket timeout (in seconds)
+        self.tls = settings.getbool('MAIL_TLS', False)
+        self.per_connection = settings.getint('MAIL_MESSAGES_PER_CONNECTION',
+                                              100)
+        self.timeout = settings.getfloat('MAIL_TIMEOUT', 60)
+
+        # The open connection (only kept open in a with statement) and the
+        # number of emails sent over it
+        self.server = None
+        self.sent = 0
+        self.pooled = False
+
+    def __enter__(self):
+        """
+        Keep the connection open for all emails sent in the with statement
+        """
+        self.pooled = True
+        return self
+
+    def __exit__(self, type, value, traceback):
+        """
+        Close the connection to the mail server
+        """
+        self.pooled = False
+        self.close()
+
+    def connect(self):
+        """
+        Connect to the SMTP host, upgrade the connection with STARTTLS and
+        log in if necessary
+        """
+
+        self.close()
+        self.server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.tls:
+            self.server.ehlo()
+            self.server.starttls()
+            self.server.ehlo()
+        if self.user and self.password:
+            self.server.login(self.user, self.password)
+        self.sent = 0
+
+    def close(self):
+        """
+        Close the connection to the mail server (if it's open)
+        """
+
+        if self.server is None:
+            return
+
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, socket.error):
+            # The server has already dropped the connection
+            self.server.close()
+        self.server = None
+
     def send(self, to, content, html_content=None):
         """
         Send contents of an email to a provided recipient (single recipient).
@@ -59,11 +127,6 @@ class Emailer(object):
         the rest of the content.
         """
 
-        # Connect to the SMTP host and log in if necessary
-        server = smtplib.SMTP(self.host, self.port)
-        if self.user and self.password:
-            server.login(self.user, self.password)
-
         # Get the subject and the plain text body
         (subject, newline, plain) = content.partition('\n')
 
@@ -84,5 +147,26 @@ class Emailer(object):
         msg['To'] = to
         msg['Subject'] = subject
 
-        server.sendmail(self.sender, [to], msg.as_string())
-        server.quit()
+        self._deliver(to, msg.as_string())
+
+    def _deliver(self, to, message):
+        """
+        Send a message over the open connection (or a new one if there's no
+        open connection, it has been used for too many emails or the server
+        has dropped it)
+        """
+
+        if self.server is None or self.sent >= self.per_connection:
+            self.connect()
+
+        try:
+            self.server.sendmail(self.sender, [to], message)
+        except (smtplib.SMTPServerDisconnected, socket.error):
+            # The server might have dropped an idle connection so we try
+            # again (once) with a new connection
+            self.connect()
+            self.server.sendmail(self.sender, [to], message)
+        self.sent += 1
+
+        if not self.pooled:
+            self.close()
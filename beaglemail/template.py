@@ -16,37 +16,85 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import gettext
-from jinja2 import Environment, PackageLoader
+import itertools
+import os
+import stat
+from jinja2 import Environment, PackageLoader, FileSystemBytecodeCache
 from scrapy.settings import CrawlerSettings
 import beagleboy.settings
 
 # Translations are located in the root directory
 gettext.install('beagle', '../locale', unicode=True)
 
-def render(path, params={}, locale=None, html=False):
+# Environments (with their compiled templates) and translations are created
+# once for each locale and reused for every email rendered in that locale
+_environments = {}
+_translations = {}
+
+def _bytecode_cache():
     """
-    Render a template with parameters but get the owner from the beagleboy
-    settings file (can be overwritten)
+    Get the on-disk cache for compiled templates (so short lived processes
+    don't have to compile them again) or None if no cache directory has
+    been set. The directory is created so only we can use it and we refuse
+    to use a directory someone else can write to since the compiled
+    templates in it are loaded and run
     """
+    settings = CrawlerSettings(beagleboy.settings)
+    directory = settings.get('MAIL_BYTECODE_CACHE_DIR')
+    if not directory:
+        return None
 
-    # Load the template from the emails environment of beagle
-    env = Environment(loader=PackageLoader('beaglemail', 'templates'),
-                      extensions=['jinja2.ext.i18n'])
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
 
-    # If locale has been provided we install the translation else we provide
-    # a null translation
-    if locale:
-        translation = gettext.translation('beagle', '../locale',
-                                          languages=[locale],
-                                          fallback=True)
-    else:
-        translation = gettext.NullTranslations()
+    status = os.stat(directory)
+    if status.st_uid != os.getuid() or \
+            status.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise ValueError('MAIL_BYTECODE_CACHE_DIR %s must be owned by and '
+                         'only writable by the user running beagle' %
+                         directory)
+
+    return FileSystemBytecodeCache(directory, 'beaglemail-%s.cache')
+
+def translation(locale=None):
+    """
+    Get the translation of a locale (a null translation if no locale has
+    been provided)
+    """
+
+    if locale not in _translations:
+        if locale:
+            _translations[locale] = gettext.translation('beagle', '../locale',
+                                                        languages=[locale],
+                                                        fallback=True)
+        else:
+            _translations[locale] = gettext.NullTranslations()
+
+    return _translations[locale]
+
+def environment(locale=None):
+    """
+    Get the environment of the email templates with the translation of a
+    locale installed
+    """
 
-    env.install_gettext_translations(translation)
+    if locale not in _environments:
+        # Load the templates from the emails environment of beagle. The
+        # templates don't change while we're running so we don't check them
+        env = Environment(loader=PackageLoader('beaglemail', 'templates'),
+                          extensions=['jinja2.ext.i18n'],
+                          bytecode_cache=_bytecode_cache(),
+                          auto_reload=False)
+        env.install_gettext_translations(translation(locale))
+        _environments[locale] = env
 
+    return _environments[locale]
 
-    # Get the template from the path
-    template = env.get_template(path)
+def _render(template, params, html):
+    """
+    Render the plain content of a template and the html version too if
+    html is set (then a tuple of both is returned)
+    """
 
     # Render the plain content version
     plain_content = template.render(params)
@@ -58,3 +106,29 @@ def render(path, params={}, locale=None, html=False):
 
     # If we get here we just return the plain content
     return plain_content
+
+def render(path, params={}, locale=None, html=False):
+    """
+    Render a template with parameters but get the owner from the beagleboy
+    settings file (can be overwritten)
+    """
+
+    # Get the template from the path in the environment of the locale (if
+    # locale has been provided the translation is installed else we get a
+    # null translation)
+    template = environment(locale).get_template(path)
+    return _render(template, params, html)
+
+def render_batch(path, records, html=False):
+    """
+    Render a template for many (locale, params) records and yield the
+    rendered content of each record in the same order (like render does).
+    Records in a row with the same locale are rendered with the same bound
+    template so the records should be grouped by locale (e.g. by sorting
+    users on their locale) and they are rendered as they're read.
+    """
+
+    for (locale, group) in itertools.groupby(records, lambda r: r[0]):
+        template = environment(locale).get_template(path)
+        for (locale, params) in group:
+            yield _render(template, params, html)
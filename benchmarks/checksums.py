@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# beagle - scrape web resources for changes and notify users by email
+# Copyright (C) 2013  The Open Knowledge Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark the memory use of the checksum state the pipeline holds during a
+crawl:
+
+    > python -m benchmarks.checksums --sizes 100000 1000000
+
+The state of each size (number of stored resources, spread over sites with
+--resources resources each) is built in a separate process, both with sets
+of hexadecimal checksums (how the pipeline used to hold them) and with
+digest sets. Every checksum is then looked up and removed, like the
+pipeline does when the resources are crawled.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import resource
+import time
+from collections import defaultdict
+from hashlib import md5
+
+from beagleboy.digests import DigestSet
+
+def checksums(size, resources):
+    """
+    Generate synthetic (site, checksum) tuples
+    """
+    for n in xrange(size):
+        yield ('http://site%d.example.org/' % (n // resources),
+               md5(str(n)).hexdigest())
+
+def build(container, size, resources):
+    """
+    Build the checksum state with the given container for each site
+    """
+    state = defaultdict(container)
+    for (site, checksum) in checksums(size, resources):
+        state[site].add(checksum)
+    return state
+
+def crawl(state, size, resources):
+    """
+    Look up and remove every checksum of the state
+    """
+    for (site, checksum) in checksums(size, resources):
+        if checksum in state[site]:
+            state[site].remove(checksum)
+
+def measure(name, size, resources, container):
+    """
+    Build and crawl the state in a child process and report the memory it
+    used (growth in peak resident set size) and the time it took
+    """
+
+    (read, write) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        started = time.time()
+        state = build(container, size, resources)
+        built = time.time()
+        memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+        crawl(state, size, resources)
+        crawled = time.time()
+        os.write(write, '%f %f %d' % (built - started, crawled - built,
+                                      memory))
+        os._exit(0)
+
+    os.close(write)
+    (build_time, crawl_time, memory) = os.read(read, 1024).split()
+    os.waitpid(pid, 0)
+
+    print('{0:<8} {1:>9} checksums {2:>8.2f}s build {3:>8.2f}s crawl '
+          '{4:>10} KB'.format(name, size, float(build_time),
+                              float(crawl_time), memory))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Checksum state benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[100000, 1000000],
+                        help='number of stored resources')
+    parser.add_argument('--resources', type=int, default=20,
+                        help='number of resources of each site')
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        measure('set', size, args.resources, set)
+        measure('digest', size, args.resources, DigestSet)
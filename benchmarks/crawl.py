@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+# beagle - scrape web resources for changes and notify users by email
+# Copyright (C) 2013  The Open Knowledge Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark a whole crawl (spider, pipeline, database and notifications)
+against a local farm of synthetic sites instead of the real web:
+
+    > python -m benchmarks.crawl --sites 200 --resources 20 --size 20000
+
+The site farm is a web server (run in a separate process) that serves N
+sites, each with a page linking to its resources. Every site gets its own
+loopback address (127.0.0.2, 127.0.0.3, ...) so the crawler treats them as
+different hosts. Responses can be delayed (--latency), a share of the links
+can go through a redirect (--redirects) and a share of the resources change
+between the seeded state and the crawl (--changes).
+
+The crawl uses its own database (beagle_benchmark by default) which is
+dropped and seeded with users and checksums before the crawl so a local
+MongoDB server is needed. Notifications are sent to a local SMTP sink.
+Settings can be overridden to compare changes, e.g.:
+
+    > python -m benchmarks.crawl --set SEEN_STORE=beagleboy.urls.BloomSeenUrls
+
+The benchmark reports items (crawled resources) per second, the peak memory
+of the crawl, the MongoDB operations (of the whole server so it should be
+otherwise idle) and the emails sent.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import resource
+import signal
+import socket
+import time
+from hashlib import md5
+
+import pymongo
+from twisted.internet import reactor
+from twisted.web.resource import Resource
+from twisted.web.server import Site, NOT_DONE_YET
+from scrapy.http import Request, Response, HtmlResponse
+from scrapy.settings import CrawlerSettings
+from scrapy.utils.misc import load_object
+import beagleboy.settings
+
+from benchmarks import smtpsink
+from crawler import crawl_webresources
+from db.collections import Users, Checksums, CrawlRuns
+
+def address(site):
+    """
+    Get the loopback address of a site (starting with 127.0.0.2)
+    """
+    n = site + 2
+    return '127.%d.%d.%d' % ((n >> 16) & 255, (n >> 8) & 255, n & 255)
+
+def site_number(address):
+    """
+    Get the site number from its loopback address
+    """
+    (a, b, c, d) = [int(part) for part in address.split('.')]
+    return (b << 16) + (c << 8) + d - 2
+
+class SiteFarm(Resource):
+    """
+    Web server resource that serves the synthetic sites. The site is picked
+    by the address the request was sent to. Everything is computed from the
+    site and resource numbers so the seeding and the server agree on what
+    the resources look like
+    """
+
+    isLeaf = True
+
+    def __init__(self, resources=20, size=20000, latency=0.0, redirects=0.0,
+                 changes=0.0, seed=0):
+        Resource.__init__(self)
+        self.resources = resources
+        self.size = size
+        self.latency = latency
+        self.redirects = redirects
+        self.changes = changes
+        self.seed = seed
+
+    def _chance(self, kind, site, number):
+        """
+        Get a number between 0 and 1 which is the same for every call with
+        the same arguments
+        """
+        key = '%s-%d-%d-%d' % (kind, self.seed, site, number)
+        return int(md5(key).hexdigest()[:8], 16) / float(0xffffffff)
+
+    def redirected(self, site, number):
+        """
+        Check if the link to a resource goes through a redirect
+        """
+        return self._chance('redirect', site, number) < self.redirects
+
+    def changed(self, site, number):
+        """
+        Check if a resource has changed since the database was seeded
+        """
+        return self._chance('change', site, number) < self.changes
+
+    def page(self, site):
+        """
+        Get the html page of a site (which links to all of its resources)
+        """
+        links = ['<li><a href="/%s/%d">Budget document %d</a></li>' % (
+                'redirect' if self.redirected(site, n) else 'resources', n, n)
+                 for n in xrange(self.resources)]
+        return ('<html><head><title>Site %d</title></head><body>'
+                '<h1>Budget documents</h1><ul>%s</ul></body></html>' % (
+                site, ''.join(links)))
+
+    def body(self, site, number, version=0):
+        """
+        Get the body of a resource in a given version
+        """
+        chunk = 'site %d resource %d version %d\n' % (site, number, version)
+        return (chunk * (self.size // len(chunk) + 1))[:self.size]
+
+    def render_GET(self, request):
+        site = site_number(request.getHost().host)
+        parts = request.path.strip('/').split('/')
+
+        if parts == ['']:
+            request.setHeader('Content-Type', 'text/html; charset=utf-8')
+            body = self.page(site)
+        elif len(parts) == 2 and parts[0] == 'redirect':
+            request.redirect('/resources/%s' % parts[1])
+            body = ''
+        elif len(parts) == 2 and parts[0] == 'resources':
+            number = int(parts[1])
+            request.setHeader('Content-Type', 'application/octet-stream')
+            body = self.body(site, number, int(self.changed(site, number)))
+        else:
+            request.setResponseCode(404)
+            body = ''
+
+        if not self.latency:
+            return body
+
+        def respond():
+            request.write(body)
+            request.finish()
+        reactor.callLater(self.latency, respond)
+        return NOT_DONE_YET
+
+def serve(farm, port):
+    """
+    Run the site farm in a child process and wait until it accepts
+    connections. Returns the process id of the child
+    """
+
+    pid = os.fork()
+    if not pid:
+        # Listen on all addresses since the sites have different addresses
+        reactor.listenTCP(port, Site(farm))
+        reactor.run()
+        os._exit(0)
+
+    while True:
+        try:
+            socket.create_connection((address(0), port)).close()
+            return pid
+        except socket.error:
+            time.sleep(0.1)
+
+def seed(settings, farm, sites, users, port):
+    """
+    Drop the benchmark database and fill it with users watching the sites
+    and the checksums of the sites' resources before they changed
+    """
+
+    connection = pymongo.MongoClient(settings.get('MONGODB_HOST'),
+                                     settings.getint('MONGODB_PORT'))
+    connection.drop_database(settings.get('MONGODB_DATABASE'))
+
+    urls = ['http://%s:%d/' % (address(site), port) for site in xrange(sites)]
+
+    # Every site is watched by one user (users get the sites in turn)
+    with Users(settings) as collection:
+        collection.collection.insert([
+                {'username': 'researcher%d@example.org' % user,
+                 'name': 'Researcher %d' % user, 'admin': False,
+                 'sites': [{'title': 'Site %d' % site, 'url': urls[site]}
+                           for site in xrange(user, sites, users)]}
+                for user in xrange(min(users, sites))])
+
+    # The checksums are computed with the fingerprinter of the crawl (the
+    # responses need a request since the fingerprinter looks at the meta)
+    fingerprinter = load_object(settings.get('FINGERPRINTER'))(settings)
+    with Checksums(settings) as checksums:
+        for site in xrange(sites):
+            documents = [{'site': urls[site], 'url': urls[site],
+                          'checksum': fingerprinter.checksum(HtmlResponse(
+                                urls[site], body=farm.page(site),
+                                encoding='utf-8',
+                                request=Request(urls[site])))}]
+            for number in xrange(farm.resources):
+                url = '%sresources/%d' % (urls[site], number)
+                documents.append({'site': urls[site], 'url': url,
+                                  'checksum': fingerprinter.checksum(
+                            Response(url, body=farm.body(site, number),
+                                     request=Request(url)))})
+            checksums.collection.insert(documents)
+
+def opcounters(settings):
+    """
+    Get the operation counters of the MongoDB server
+    """
+    connection = pymongo.MongoClient(settings.get('MONGODB_HOST'),
+                                     settings.getint('MONGODB_PORT'))
+    return connection.admin.command('serverStatus')['opcounters']
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark a crawl against a local site farm')
+    parser.add_argument('--sites', type=int, default=200,
+                        help='number of sites')
+    parser.add_argument('--resources', type=int, default=20,
+                        help='number of resources of each site')
+    parser.add_argument('--size', type=int, default=20000,
+                        help='size of each resource in bytes')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds before each response is sent')
+    parser.add_argument('--redirects', type=float, default=0.1,
+                        help='share of links that are redirected')
+    parser.add_argument('--changes', type=float, default=0.05,
+                        help='share of resources that have changed')
+    parser.add_argument('--users', type=int, default=50,
+                        help='number of users watching the sites')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for the redirects and changes')
+    parser.add_argument('--port', type=int, default=8099,
+                        help='port of the site farm')
+    parser.add_argument('--smtp-port', type=int, default=8025,
+                        help='port of the SMTP sink')
+    parser.add_argument('--database', default='beagle_benchmark',
+                        help='database to use (it is dropped!)')
+    parser.add_argument('--set', action='append', default=[],
+                        metavar='NAME=VALUE', help='override a setting')
+    args = parser.parse_args()
+
+    if args.database == beagleboy.settings.MONGODB_DATABASE:
+        parser.error('refusing to drop the beagle database')
+
+    overrides = {'MONGODB_DATABASE': args.database,
+                 'MAIL_HOST': '127.0.0.1', 'MAIL_PORT': args.smtp_port,
+                 'MAIL_FROM': 'beagle@example.org', 'MAIL_USER': '',
+                 'MAIL_PASS': '', 'LOG_LEVEL': 'WARNING'}
+    overrides.update(setting.split('=', 1) for setting in args.set)
+
+    settings = CrawlerSettings(beagleboy.settings)
+    settings.overrides.update(overrides)
+
+    farm = SiteFarm(args.resources, args.size, args.latency, args.redirects,
+                    args.changes, args.seed)
+    pid = serve(farm, args.port)
+    try:
+        seed(settings, farm, args.sites, args.users, args.port)
+        sink = smtpsink.start(port=args.smtp_port)
+
+        before = opcounters(settings)
+        started = time.time()
+        crawl_webresources(overrides=overrides)
+        elapsed = time.time() - started
+        after = opcounters(settings)
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+
+    with CrawlRuns(settings) as runs:
+        items = runs.collection.count()
+    changed = len([site for site in xrange(args.sites)
+                   if any(farm.changed(site, n)
+                          for n in xrange(args.resources))])
+
+    print('{0} sites, {1} resources each ({2} bytes)'.format(
+            args.sites, args.resources, args.size))
+    print('{0:<20} {1:>12.1f}'.format('seconds', elapsed))
+    print('{0:<20} {1:>12}'.format('items', items))
+    print('{0:<20} {1:>12.1f}'.format('items/sec', items / elapsed))
+    # ru_maxrss is in kilobytes on Linux
+    print('{0:<20} {1:>12.1f}'.format('peak RSS (MB)', resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+    for op in sorted(after):
+        print('{0:<20} {1:>12}'.format('mongo ' + op,
+                                       after[op] - before.get(op, 0)))
+    print('{0:<20} {1:>12}'.format('changed sites', changed))
+    print('{0:<20} {1:>12}'.format('emails', sink.messages))
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# beagle - scrape web resources for changes and notify users by email
+# Copyright (C) 2013  The Open Knowledge Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark the fingerprinters against a corpus of real pages to see how many
+false change alerts each of them produces.
+
+The corpus is a directory with a subdirectory for each page. Each page
+directory holds a file called url (the url of the page) and snapshots of the
+page (fetched at different times) which are compared in filename order.
+A corpus can be collected with:
+
+    > python -m benchmarks.fingerprint collect urls.txt corpus/ --times 5
+
+And then benchmarked with:
+
+    > python -m benchmarks.fingerprint run corpus/ --distance 3
+
+Every change (flip) of a checksum between two snapshots costs a checksum
+update, a lookup of the users watching the site and an email to each of
+them so the number of flips is what we want to minimise.
+"""
+
+from __future__ import print_function
+
+import argparse
+import hashlib
+import os
+import time
+import urllib2
+
+from scrapy.http import Request, HtmlResponse
+from scrapy.settings import CrawlerSettings
+from scrapy.utils.misc import load_object
+import beagleboy.settings
+
+from beagleboy.fingerprint import hamming
+
+FINGERPRINTERS = ('beagleboy.fingerprint.Fingerprinter',
+                  'beagleboy.fingerprint.NormalizedFingerprinter',
+                  'beagleboy.fingerprint.SimHashFingerprinter')
+
+def collect(urls, corpus, times, interval):
+    """
+    Fetch every url in the urls file a number of times (waiting interval
+    seconds between rounds) and store the snapshots in the corpus directory
+    """
+
+    with open(urls) as urlfile:
+        urls = [u.strip() for u in urlfile if u.strip()]
+
+    for n in xrange(times):
+        for url in urls:
+            page = os.path.join(corpus, hashlib.md5(url).hexdigest())
+            if not os.path.isdir(page):
+                os.makedirs(page)
+                with open(os.path.join(page, 'url'), 'w') as urlfile:
+                    urlfile.write(url)
+
+            try:
+                body = urllib2.urlopen(url, timeout=30).read()
+            except Exception as e:
+                print('Could not fetch {0}: {1}'.format(url, e))
+                continue
+
+            with open(os.path.join(page, '%04d.html' % n), 'wb') as snapshot:
+                snapshot.write(body)
+
+        if n < times - 1:
+            time.sleep(interval)
+
+def load(corpus):
+    """
+    Load the corpus as a list of (url, [snapshot bodies]) tuples
+    """
+
+    pages = []
+    for name in sorted(os.listdir(corpus)):
+        page = os.path.join(corpus, name)
+        with open(os.path.join(page, 'url')) as urlfile:
+            url = urlfile.read().strip()
+
+        snapshots = []
+        for snapshot in sorted(os.listdir(page)):
+            if snapshot != 'url':
+                with open(os.path.join(page, snapshot), 'rb') as body:
+                    snapshots.append(body.read())
+        pages.append((url, snapshots))
+
+    return pages
+
+def run(corpus, distance):
+    """
+    Compute the checksums of all snapshots with each fingerprinter and
+    report how many times the checksums of each page flipped
+    """
+
+    settings = CrawlerSettings(beagleboy.settings)
+    pages = load(corpus)
+    snapshots = sum(len(s) for (u, s) in pages)
+    print('{0} pages, {1} snapshots'.format(len(pages), snapshots))
+
+    baseline = None
+    for path in FINGERPRINTERS:
+        fingerprinter = load_object(path)(settings)
+        simhash = path.endswith('SimHashFingerprinter')
+
+        flips = 0
+        started = time.time()
+        for url, bodies in pages:
+            previous = None
+            for body in bodies:
+                # The fingerprinters look at the meta so we need a request
+                checksum = fingerprinter.checksum(HtmlResponse(
+                        url, body=body, request=Request(url)))
+                if previous is not None and checksum != previous:
+                    # SimHashes within the distance aren't changes
+                    if not (simhash and hamming(checksum, previous) <= distance):
+                        flips += 1
+                previous = checksum
+        elapsed = time.time() - started
+
+        if baseline is None:
+            baseline = flips
+        reduction = 100.0 * (baseline - flips) / baseline if baseline else 0.0
+        print('{0:<48} {1:>6} flips {2:>6.1f}% fewer {3:>8.2f} ms/page'.format(
+                path, flips, reduction, 1000.0 * elapsed / max(snapshots, 1)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fingerprinter benchmark')
+    commands = parser.add_subparsers(dest='command')
+
+    collect_parser = commands.add_parser('collect', help='collect a corpus')
+    collect_parser.add_argument('urls', help='file with one url per line')
+    collect_parser.add_argument('corpus', help='corpus directory')
+    collect_parser.add_argument('--times', type=int, default=5,
+                                help='number of snapshots of each page')
+    collect_parser.add_argument('--interval', type=int, default=3600,
+                                help='seconds between snapshots')
+
+    run_parser = commands.add_parser('run', help='benchmark a corpus')
+    run_parser.add_argument('corpus', help='corpus directory')
+    run_parser.add_argument('--distance', type=int, default=3,
+                            help='SimHash distance (in bits)')
+
+    args = parser.parse_args()
+    if args.command == 'collect':
+        collect(args.urls, args.corpus, args.times, args.interval)
+    else:
+        run(args.corpus, args.distance)
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+# beagle - scrape web resources for changes and notify users by email
+# Copyright (C) 2013  The Open Knowledge Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compare the pages per second of scrapy's SgmlLinkExtractor and our lxml
+based ResourceLinkExtractor, both configured like the spider's rule:
+
+    > python -m benchmarks.linkextractor --corpus pages/
+
+The corpus is a directory of html files. If no corpus is given a fixed
+synthetic corpus (the same on every run) is generated.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import time
+
+from scrapy.contrib.linkextractors.sgml import SgmlLinkExtractor
+from scrapy.http import HtmlResponse
+
+from beagleboy.linkextractors import ResourceLinkExtractor
+from beagleboy.spiders.webresources import WebResourceSpider
+
+def synthetic(pages, seed=1):
+    """
+    Generate a fixed corpus of budget portal like pages with links,
+    frames, scripts, stylesheets and images
+    """
+
+    generator = random.Random(seed)
+    corpus = []
+    for page in xrange(pages):
+        parts = ['<html><head><title>Budget %d</title>' % page,
+                 '<link rel="stylesheet" href="/css/site.css">',
+                 '<style>body { background: url(/img/bg%d.png) }</style>' % page,
+                 '<script src="/js/app.js"></script></head><body>']
+        for n in xrange(generator.randint(50, 300)):
+            kind = generator.random()
+            if kind < 0.6:
+                parts.append('<p>Item %d <a href="/docs/%d.pdf">Budget '
+                             'document %d</a></p>' % (n, n, n))
+            elif kind < 0.8:
+                parts.append('<img src="/img/%d.png" srcset="/img/%d@2x.png '
+                             '2x" alt="chart">' % (n, n))
+            elif kind < 0.9:
+                parts.append('<iframe src="http://viewer.example.org/%d">'
+                             '</iframe>' % n)
+            else:
+                parts.append('<object data="/flash/%d.swf"><embed '
+                             'src="/flash/%d.swf"></object>' % (n, n))
+        parts.append('</body></html>')
+        corpus.append(''.join(parts))
+    return corpus
+
+def load(directory):
+    """
+    Load all html files in a directory
+    """
+    corpus = []
+    for name in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, name), 'rb') as page:
+            corpus.append(page.read())
+    return corpus
+
+def measure(name, extractor, responses, rounds):
+    """
+    Extract the links of all responses a number of times and report the
+    pages per second and the number of links found per round
+    """
+
+    started = time.time()
+    for n in xrange(rounds):
+        links = sum(len(extractor.extract_links(r)) for r in responses)
+    elapsed = time.time() - started
+
+    print('{0:<24} {1:>10.1f} pages/s {2:>8} links'.format(
+            name, len(responses) * rounds / elapsed, links))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Link extractor benchmark')
+    parser.add_argument('--corpus', help='directory of html files')
+    parser.add_argument('--pages', type=int, default=200,
+                        help='number of synthetic pages')
+    parser.add_argument('--rounds', type=int, default=5,
+                        help='number of times the corpus is processed')
+    args = parser.parse_args()
+
+    corpus = load(args.corpus) if args.corpus else synthetic(args.pages)
+    responses = [HtmlResponse('http://budget.example.org/page/%d' % n,
+                              body=body) for (n, body) in enumerate(corpus)]
+
+    # The extractors are set up like the spider's rule (the sgml extractor
+    # gets the tags and attributes it used to have in the spider)
+    sgml = SgmlLinkExtractor(tags=('a', 'iframe', 'object', 'embed', 'script'),
+                             attrs=('href', 'src', 'data'),
+                             deny=('http://wordpress.org', ))
+    resource = WebResourceSpider.rules[0].link_extractor
+
+    measure('SgmlLinkExtractor', sgml, responses, args.rounds)
+    measure('ResourceLinkExtractor', resource, responses, args.rounds)
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+# beagle - scrape web resources for changes and notify users by email
+# Copyright (C) 2013  The Open Knowledge Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark the reminder emails (rendering, the outbox and delivery) against
+a local SMTP sink:
+
+    > python -m benchmarks.mail --users 10000 --sites 3 --latency 0.05
+
+The benchmark uses its own database (beagle_benchmark by default) which is
+dropped and seeded with synthetic users (each watching --sites sites that
+are in their grace period, with a mix of locales) so a local MongoDB server
+is needed. The emails are delivered in the benchmark process (not by
+queued jobs) to the SMTP sink which can delay (--latency), reject
+(--failures) or drop (--drops) messages. Settings can be overridden to
+compare changes, e.g.:
+
+    > python -m benchmarks.mail --set MAIL_CONNECTIONS=8 --set MAIL_DIGESTS=1
+
+Each reminder function (budget_reminder, report_reminder and report_due)
+is run in a separate process and the benchmark reports messages per
+second, the time spent rendering templates, sending the emails and in the
+rest (mostly the database) and the peak memory of the process.
+"""
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import os
+import resource
+import time
+
+import pymongo
+from scrapy.settings import CrawlerSettings
+import beagleboy.settings
+
+from beaglemail import template
+from benchmarks import smtpsink
+from db.collections import Users, Outbox, chunks
+import reminder
+
+LOCALES = ['en', 'es', 'fr', None]
+
+class Timer(object):
+    """
+    Wrap a function and add up the time spent in it
+    """
+
+    def __init__(self, function):
+        self.function = function
+        self.seconds = 0.0
+
+    def __call__(self, *args, **kwargs):
+        started = time.time()
+        try:
+            return self.function(*args, **kwargs)
+        finally:
+            self.seconds += time.time() - started
+
+def seed(settings, users, sites):
+    """
+    Drop the benchmark database and fill it with users watching sites that
+    are in their grace period
+    """
+
+    connection = pymongo.MongoClient(settings.get('MONGODB_HOST'),
+                                     settings.getint('MONGODB_PORT'))
+    connection.drop_database(settings.get('MONGODB_DATABASE'))
+
+    today = datetime.datetime.combine(datetime.date.today(),
+                                      datetime.time(0))
+    documents = ({'username': 'researcher%d@example.org' % user,
+                  'name': 'Researcher %d' % user, 'admin': False,
+                  'locale': LOCALES[user % len(LOCALES)],
+                  'sites': [{'title': 'Budget document %d-%d' % (user, site),
+                             'url': 'http://site%d.example.org/' % (
+                                user * sites + site),
+                             'search_dates': {
+                                'start': today - datetime.timedelta(days=7),
+                                'end': today + datetime.timedelta(days=21)}}
+                            for site in xrange(sites)]}
+                 for user in xrange(users))
+
+    with Users(settings) as collection:
+        for chunk in chunks(documents, 1000):
+            collection.collection.insert(chunk)
+
+def measure(name, function, sink):
+    """
+    Run a reminder function in a child process (so the peak memory is its
+    own) and report how long it took and where the time went
+    """
+
+    before = (sink.messages, sink.failed, sink.dropped)
+
+    (read, write) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # The reminders render through render_batch which renders each
+        # email with _render
+        render = template._render = Timer(template._render)
+        send = reminder.deliver = Timer(reminder.deliver)
+        started = time.time()
+        function()
+        elapsed = time.time() - started
+        memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - memory
+        os.write(write, '%f %f %f %d' % (elapsed, render.seconds,
+                                         send.seconds, memory))
+        os._exit(0)
+
+    os.close(write)
+    (elapsed, render, send, memory) = os.read(read, 1024).split()
+    os.waitpid(pid, 0)
+    (elapsed, render, send) = (float(elapsed), float(render), float(send))
+
+    (messages, failed, dropped) = (sink.messages - before[0],
+                                   sink.failed - before[1],
+                                   sink.dropped - before[2])
+    print('{0:<16} {1:>8} {2:>6} {3:>6} {4:>9.1f} {5:>8.2f} {6:>8.2f} '
+          '{7:>8.2f} {8:>8.2f} {9:>9}'.format(
+            name, messages, failed, dropped, messages / elapsed, elapsed,
+            render, send, elapsed - render - send, memory))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the reminder emails against an SMTP sink')
+    parser.add_argument('--users', type=int, default=10000,
+                        help='number of users')
+    parser.add_argument('--sites', type=int, default=3,
+                        help='number of sites each user watches')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds before the sink accepts a message')
+    parser.add_argument('--failures', type=float, default=0.0,
+                        help='share of messages the sink rejects')
+    parser.add_argument('--drops', type=float, default=0.0,
+                        help='share of messages whose connection is dropped')
+    parser.add_argument('--smtp-port', type=int, default=8025,
+                        help='port of the SMTP sink')
+    parser.add_argument('--database', default='beagle_benchmark',
+                        help='database to use (it is dropped!)')
+    parser.add_argument('--set', action='append', default=[],
+                        metavar='NAME=VALUE', help='override a setting')
+    parser.add_argument('functions', nargs='*',
+                        default=['budget_reminder', 'report_reminder',
+                                 'report_due'],
+                        help='reminder functions to run')
+    args = parser.parse_args()
+
+    if args.database == beagleboy.settings.MONGODB_DATABASE:
+        parser.error('refusing to drop the beagle database')
+
+    # The reminder functions load the beagleboy settings themselves so we
+    # override them in the settings module. The emails are delivered in
+    # the benchmark process so we can time the delivery
+    overrides = {'MONGODB_DATABASE': args.database,
+                 'MAIL_HOST': '127.0.0.1', 'MAIL_PORT': args.smtp_port,
+                 'MAIL_FROM': 'beagle@example.org', 'MAIL_USER': '',
+                 'MAIL_PASS': '', 'MAIL_QUEUE_DELIVERY': False}
+    overrides.update(setting.split('=', 1) for setting in args.set)
+    for (name, value) in overrides.iteritems():
+        setattr(beagleboy.settings, name, value)
+
+    settings = CrawlerSettings(beagleboy.settings)
+    seed(settings, args.users, args.sites)
+    sink = smtpsink.start(port=args.smtp_port, latency=args.latency,
+                          failures=args.failures, drops=args.drops)
+
+    functions = {
+        'budget_reminder': reminder.budget_reminder,
+        'report_reminder': lambda: reminder.report_reminder(
+            datetime.date.today() + datetime.timedelta(days=4)),
+        'report_due': reminder.report_due}
+
+    print('{0} users, {1} sites each'.format(args.users, args.sites))
+    print('{0:<16} {1:>8} {2:>6} {3:>6} {4:>9} {5:>8} {6:>8} {7:>8} '
+          '{8:>8} {9:>9}'.format('function', 'messages', 'failed', 'dropped',
+                                 'msgs/sec', 'total s', 'render s',
+                                 'send s', 'other s', 'peak KB'))
+    for name in args.functions:
+        measure(name, functions[name], sink)
+
+    # Emails that failed are left in the outbox to be retried
+    with Outbox(settings) as outbox:
+        print('{0} emails left in the outbox'.format(outbox.pending()))
+    sink.stop()
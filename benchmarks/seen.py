@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+# beagle - scrape web resources for changes and notify users by email
+# Copyright (C) 2013  The Open Knowledge Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark the memory use and throughput of the seen url stores:
+
+    > python -m benchmarks.seen --sizes 10000 100000 1000000
+
+Each store is filled in a separate process with synthetic urls (a fifth of
+which are duplicates) so the peak memory of one doesn't hide the other.
+The old approach of copying the seen set on every response can be included
+with --legacy (it's quadratic so only use it with small sizes).
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import resource
+import time
+
+from beagleboy.urls import SeenUrls, BloomSeenUrls
+
+# Number of links extracted per response in the legacy approach
+LINKS_PER_RESPONSE = 20
+
+def urls(size):
+    """
+    Generate synthetic urls, every fifth url is a different version (case,
+    trailing slash and tracking parameter) of a previous url
+    """
+    for n in xrange(size):
+        if n % 5 == 4:
+            yield 'HTTP://Site%d.example.org/doc/%d/?utm_source=x' % (
+                n % 1000, n - 1)
+        else:
+            yield 'http://site%d.example.org/doc/%d?b=1&a=%d' % (
+                n % 1000, n, n)
+
+def legacy(size):
+    """
+    The old seen set handling: a new set was created on every response
+    """
+    seen = set()
+    batch = []
+    for url in urls(size):
+        batch.append(url)
+        if len(batch) == LINKS_PER_RESPONSE:
+            links = [u for u in batch if u.rstrip('/') not in seen]
+            seen = seen.union([u.rstrip('/') for u in links])
+            batch = []
+    return seen
+
+def fill(store, size):
+    """
+    Add all urls to the store (add checks if the url has been seen)
+    """
+    for url in urls(size):
+        store.add(url)
+    return store
+
+def measure(name, size, function):
+    """
+    Run the function in a child process and report the time it took and the
+    memory it used (growth in peak resident set size)
+    """
+
+    (read, write) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        started = time.time()
+        result = function()
+        elapsed = time.time() - started
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(write, '%f %d %d' % (elapsed, after - before, len(result)))
+        os._exit(0)
+
+    os.close(write)
+    (elapsed, memory, stored) = os.read(read, 1024).split()
+    os.waitpid(pid, 0)
+
+    elapsed = float(elapsed)
+    print('{0:<8} {1:>9} urls {2:>9} stored {3:>10.0f} urls/s {4:>10} KB'.format(
+            name, size, stored, size / elapsed if elapsed else 0, memory))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Seen url store benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10000, 100000, 1000000],
+                        help='number of urls to add')
+    parser.add_argument('--error-rate', type=float, default=0.001,
+                        help='error rate of the Bloom filter')
+    parser.add_argument('--legacy', action='store_true',
+                        help='include the old set copying approach')
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        if args.legacy:
+            measure('legacy', size, lambda: legacy(size))
+        measure('set', size, lambda: fill(SeenUrls(), size))
+        measure('bloom', size, lambda: fill(
+                BloomSeenUrls(size, args.error_rate), size))
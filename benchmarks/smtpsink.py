@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+# beagle - scrape web resources for changes and notify users by email
+# Copyright (C) 2013  The Open Knowledge Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A local SMTP server that accepts and counts messages without delivering
+them so the benchmarks can send emails without bothering anyone. It can
+also be run on its own (to point a beagle at it):
+
+    > python -m benchmarks.smtpsink --port 8025 --latency 0.2 --failures 0.01
+
+The server is a Twisted ESMTP server running in a separate process so it
+handles many connections at once (like a real mail server). Each message
+can be delayed (--latency seconds before it's accepted) and a share of the
+messages can be rejected (--failures) or have their connection dropped
+(--drops) to see how the sender copes.
+"""
+
+from __future__ import print_function
+
+import argparse
+import atexit
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import time
+
+from twisted.internet import defer, protocol, reactor, task
+from twisted.mail import smtp
+from twisted.python import log
+from zope.interface import implementer
+
+@implementer(smtp.IMessage)
+class SinkMessage(object):
+    """
+    A message received by the sink. The lines are thrown away and the
+    message is accepted, rejected or its connection dropped when it ends
+    """
+
+    def __init__(self, factory, transport):
+        self.factory = factory
+        self.transport = transport
+
+    def lineReceived(self, line):
+        pass
+
+    def eomReceived(self):
+        return task.deferLater(reactor, self.factory.latency,
+                               self.factory.received, self.transport)
+
+    def connectionLost(self):
+        pass
+
+@implementer(smtp.IMessageDelivery)
+class SinkDelivery(object):
+    """
+    Accept every sender and recipient
+    """
+
+    def __init__(self, factory, transport):
+        self.factory = factory
+        self.transport = transport
+
+    def receivedHeader(self, helo, origin, recipients):
+        return 'Received: by the beagle SMTP sink'
+
+    def validateFrom(self, helo, origin):
+        return origin
+
+    def validateTo(self, user):
+        return lambda: SinkMessage(self.factory, self.transport)
+
+class SinkFactory(protocol.ServerFactory):
+    """
+    Create ESMTP connections which deliver to the sink and count the
+    messages in counters shared with the process that started the sink
+    """
+
+    def __init__(self, counters, latency=0.0, failures=0.0, drops=0.0,
+                 seed=0):
+        self.counters = counters
+        self.latency = latency
+        self.failures = failures
+        self.drops = drops
+        self.random = random.Random(seed)
+
+    def buildProtocol(self, addr):
+        connection = smtp.ESMTP()
+        connection.factory = self
+        connection.delivery = SinkDelivery(self, connection)
+        return connection
+
+    def _count(self, name):
+        with self.counters[name].get_lock():
+            self.counters[name].value += 1
+
+    def received(self, connection):
+        """
+        Decide what happens to a message that has been received
+        """
+        chance = self.random.random()
+        if chance < self.drops:
+            self._count('dropped')
+            connection.transport.loseConnection()
+            return defer.Deferred()
+        if chance < self.drops + self.failures:
+            self._count('failed')
+            raise smtp.SMTPError('Rejected by the sink')
+        self._count('messages')
+
+class SMTPSink(object):
+    """
+    Handle on an SMTP sink running in a child process. The number of
+    accepted, rejected and dropped messages are read from the counters the
+    sink shares with this process
+    """
+
+    def __init__(self, pid, counters):
+        self.pid = pid
+        self.counters = counters
+
+    @property
+    def messages(self):
+        return self.counters['messages'].value
+
+    @property
+    def failed(self):
+        return self.counters['failed'].value
+
+    @property
+    def dropped(self):
+        return self.counters['dropped'].value
+
+    def stop(self):
+        """
+        Stop the sink (if it's still running)
+        """
+        if self.pid is None:
+            return
+        os.kill(self.pid, signal.SIGTERM)
+        os.waitpid(self.pid, 0)
+        self.pid = None
+
+def start(host='127.0.0.1', port=8025, latency=0.0, failures=0.0, drops=0.0,
+          seed=0):
+    """
+    Start an SMTP sink in a child process, wait until it accepts
+    connections and return a handle on it (it's stopped on exit)
+    """
+
+    counters = dict((name, multiprocessing.Value('l', 0))
+                    for name in ('messages', 'failed', 'dropped'))
+    factory = SinkFactory(counters, latency, failures, drops, seed)
+
+    pid = os.fork()
+    if not pid:
+        # Rejected messages are logged as errors so we throw away the log
+        log.startLogging(open(os.devnull, 'w'), setStdout=False)
+        reactor.listenTCP(port, factory, interface=host)
+        reactor.run()
+        os._exit(0)
+
+    sink = SMTPSink(pid, counters)
+    atexit.register(sink.stop)
+
+    while True:
+        try:
+            socket.create_connection((host, port)).close()
+            return sink
+        except socket.error:
+            time.sleep(0.1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local SMTP sink')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='address to listen on')
+    parser.add_argument('--port', type=int, default=8025,
+                        help='port to listen on')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds before each message is accepted')
+    parser.add_argument('--failures', type=float, default=0.0,
+                        help='share of messages that are rejected')
+    parser.add_argument('--drops', type=float, default=0.0,
+                        help='share of messages whose connection is dropped')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for the failures and drops')
+    args = parser.parse_args()
+
+    sink = start(args.host, args.port, args.latency, args.failures,
+                 args.drops, args.seed)
+    print('SMTP sink listening on {0}:{1} (ctrl-c to stop)'.format(
+            args.host, args.port))
+    try:
+        while True:
+            time.sleep(5)
+            print('{0} accepted, {1} rejected, {2} dropped'.format(
+                    sink.messages, sink.failed, sink.dropped))
+    except KeyboardInterrupt:
+        sink.stop()
@@ -19,25 +19,51 @@ from twisted.internet import reactor
 from scrapy.crawler import Crawler
 from scrapy import log, signals
 from scrapy.settings import CrawlerSettings
+from rq import Queue
+from worker import conn
 
 from beagleboy.spiders.webresources import WebResourceSpider
+from db.collections import Users, Checksums, Checkpoints, Crawls, Snapshots
+from reminder import change_notification
 import beagleboy.settings
 
-def crawl_webresources():
+def crawl_webresources(sites=None, run=None, shard=0, shards=1,
+                       overrides=None):
     """
     Crawl web resources using the beagleboy webresource spider.
     This methods should be queued to be run as a background process.
+
+    The crawl can be split into shards that are crawled by separate jobs.
+    Each shard gets its list of sites and the id of the crawl run. When the
+    last shard of a run has finished a job to merge the shards is queued.
+
+    Shards of a run are checkpointed while they're crawled so if the job is
+    retried it resumes where it stopped (or does nothing if the shard has
+    already finished).
+
+    Settings can be overridden with a dictionary (e.g. to crawl with a
+    different database as the benchmarks do).
     """
     
     # Create a crawler with the beagleboy settings
-    crawler = Crawler(CrawlerSettings(settings_module=beagleboy.settings))
+    settings = CrawlerSettings(settings_module=beagleboy.settings)
+    settings.overrides.update(overrides or {})
+
+    # If this shard has already finished we only make sure the run is merged
+    if run is not None:
+        with Crawls(settings) as crawls:
+            if crawls.finished(run, shard):
+                finish_shard(settings, run, shard, shards)
+                return
+
+    crawler = Crawler(settings)
     # Add a signal to stop the reactor when the spider closes
     crawler.signals.connect(reactor.stop, signal=signals.spider_closed)
     # Configure the crawler
     crawler.configure()
 
     # Create a web resource spider and add that as the crawler
-    spider = WebResourceSpider()
+    spider = WebResourceSpider(sites=sites, run=run, shard=shard)
     crawler.crawl(spider)
 
     # Start crawling and logging
@@ -46,3 +72,56 @@ def crawl_webresources():
 
     # Run the reactor (this block until spider closes)
     reactor.run()
+
+    # The shard is only finished if the pipeline wrote everything, otherwise
+    # the checkpoint is kept and the job fails so it's retried
+    if run is not None:
+        if not getattr(spider, 'completed', False):
+            raise RuntimeError('Shard %d of crawl run %s did not complete' %
+                               (shard, run))
+        finish_shard(settings, run, shard, shards)
+
+def finish_shard(settings, run, shard, shards):
+    """
+    Mark a shard of a crawl run as finished and remove its checkpoint. If
+    all shards of the run have finished we queue the merge (the connection
+    is passed explicitly instead of relying on rq's connection stack)
+    """
+
+    with Crawls(settings) as crawls:
+        merge = crawls.finish(run, shard, shards)
+
+    with Checkpoints(settings) as checkpoints:
+        checkpoints.clear(run, shard)
+
+    if merge:
+        Queue(connection=conn).enqueue(merge_crawl, run)
+
+def merge_crawl(run):
+    """
+    Merge the shards of a crawl run by notifying users of all of the sites
+    that changed during the run. Checksums of sites that are no longer
+    watched by anyone are removed.
+    """
+
+    settings = CrawlerSettings(settings_module=beagleboy.settings)
+
+    # Get the changed sites (None if the run has already been merged)
+    with Crawls(settings) as crawls:
+        sites = crawls.merge(run)
+    if sites is None:
+        return
+
+    # The shards only know about their own sites so we remove the checksums
+    # of sites that are no longer watched here
+    with Users(settings) as users:
+        urls = users.urls()
+    with Checksums(settings) as checksums:
+        checksums.retain(urls)
+
+    # Old snapshots are removed when the whole run is done
+    if settings.getbool('SNAPSHOTS_ENABLED'):
+        with Snapshots(settings) as snapshots:
+            snapshots.prune(settings.getint('SNAPSHOT_RETENTION', 90))
+
+    change_notification(sites, settings)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# beagle - scrape web resources for changes and notify users by email
+# Copyright (C) 2013  The Open Knowledge Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function
+
+from scrapy.settings import CrawlerSettings
+import beagleboy.settings
+from db.collections import CrawlRuns
+import argparse
+
+def report(run=None, limit=10, threshold=1.5):
+    """
+    Print a report of a crawl run (the latest one by default): the slowest
+    hosts, the largest resources and the hosts that have become slower
+    since the previous run (their average latency has grown by more than
+    the threshold factor)
+    """
+
+    # We piggyback on the beagleboy settings by loading and using them
+    settings = CrawlerSettings(beagleboy.settings)
+
+    with CrawlRuns(settings) as runs:
+        ids = runs.runs()
+        if not ids:
+            print('No crawl runs found')
+            return
+
+        run = run or ids[0]
+        previous = [r for r in ids if r < run]
+        hosts = runs.hosts(run)
+        largest = runs.largest(run, limit)
+        before = runs.hosts(previous[0]) if previous else {}
+
+    print('Crawl run {0}: {1} resources from {2} hosts'.format(
+            run, sum(h['resources'] for h in hosts.itervalues()), len(hosts)))
+
+    print('\nSlowest hosts (total latency)')
+    slowest = sorted(hosts.iteritems(), key=lambda h: h[1]['total_latency'],
+                     reverse=True)
+    for host, h in slowest[:limit]:
+        print('{0:<40} {1:>8.1f}s total {2:>6.2f}s avg {3:>5} resources '
+              '{4:>4} errors'.format(host, h['total_latency'] or 0,
+                                     h['latency'] or 0, h['resources'],
+                                     h['errors']))
+
+    print('\nLargest resources')
+    for r in largest:
+        print('{0:>12} bytes {1}'.format(r.get('bytes') or 0, r['url']))
+
+    if not before:
+        return
+
+    print('\nRegressions since {0} (average latency)'.format(previous[0]))
+    for host, h in slowest:
+        old = before.get(host, {}).get('latency')
+        if old and h['latency'] and h['latency'] > old * threshold:
+            print('{0:<40} {1:>6.2f}s -> {2:>6.2f}s'.format(host, old,
+                                                            h['latency']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Report on a crawl run')
+    parser.add_argument('--run', help='crawl run (defaults to the latest)')
+    parser.add_argument('--limit', type=int, default=10,
+                        help='number of hosts and resources to show')
+    parser.add_argument('--threshold', type=float, default=1.5,
+                        help='latency growth considered a regression')
+    args = parser.parse_args()
+
+    report(args.run, args.limit, args.threshold)
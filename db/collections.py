@@ -16,7 +16,24 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from db.mongo import MongoCollection
+from bson.binary import Binary
+from bson.objectid import ObjectId
+from pymongo.errors import OperationFailure
 import datetime
+import difflib
+import itertools
+import math
+import zlib
+
+def chunks(iterable, size):
+    """
+    Split an iterable into lists of (at most) size items
+    """
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, size))
 
 class Users(MongoCollection):
     """
@@ -35,23 +52,25 @@ class Users(MongoCollection):
         self.settings = settings
         super(Users,self).__init__(settings, *args, **kwargs)
 
-    def all(self, filters={}):
+    def all(self, filters={}, fields=None, sort=None, batch_size=1000):
         """
-        Get all users (they can be filtered via a parameter value
+        Get all users (they can be filtered via a parameter value, sorted
+        with a list of (key, direction) pairs and only a list of fields can
+        be fetched). The users are yielded as they're read from the
+        database (batch_size at a time) so they have to be used before the
+        connection is closed.
         """
 
-        # Get the user list and if none are found return an empty list
-        users = list(self.collection.find(filters))
+        # We always need the username since that's the email
+        if fields is not None:
+            fields = list(set(fields) | set(['username']))
 
-        # If no users are found we return an empty list
-        if users is None:
-            return []
+        cursor = self.collection.find(filters, fields=fields, sort=sort)
 
-        # Rename _id key to email and return users
-        for user in users:
+        # Rename username key to email and yield the users
+        for user in cursor.batch_size(batch_size):
             user['email'] = user.pop('username')
-
-        return users
+            yield user
 
     def countries(self):
         """
@@ -69,13 +88,13 @@ class Users(MongoCollection):
         return set([u['_id'].split(' - ')[1] for u in self.aggregate(pipeline)])
         
 
-    def remindees(self):
+    def remindees(self, batch_size=1000):
         """
         Get users from the database who's sites fall within the grace period
-        and return them in a list with email addresses, names, preferred 
-        language, and the site titles they watch.
+        and yield them with email addresses, names, preferred language, and
+        the site titles they watch (batch_size users are read at a time).
 
-        Output is a list of dictionaries for each user found and the sites that
+        Output is a dictionary for each user found and the sites that
         that fall are in the grace period.
         """
 
@@ -86,8 +105,14 @@ class Users(MongoCollection):
                                           datetime.time(0))
 
         # We only grab pages for non-muted users and within the grace period
-        # Information we need are email, name, and language
-        pipeline = [{'$match':{'mute':{'$ne':True}}},
+        # Information we need are email, name, and language (users without
+        # any site in the grace period are skipped before unwinding)
+        grace = {'search_dates.start': {'$lte': today},
+                 'search_dates.end': {'$gte': today}}
+        pipeline = [{'$match':{'mute':{'$ne':True},
+                               'sites':{'$elemMatch':grace}}},
+                    {'$project': {'username':1, 'name':1, 'locale':1,
+                                  'sites.title':1, 'sites.search_dates':1}},
                     {'$unwind': '$sites'}, 
                     {'$match': {'sites.search_dates.start': {'$lte': today},
                                 'sites.search_dates.end': {'$gte':today}}},
@@ -98,21 +123,29 @@ class Users(MongoCollection):
                                           {'title':'$sites.title', 
                                            'date':'$sites.search_dates.start'
                                            }}}
-                    }]
+                    },
+                    # Users with the same locale come together so their
+                    # emails can be rendered together
+                    {'$sort': {'_id.locale': 1}}]
         
-        # Aggregate the results and return a list of the users
-        return [{'email':user['_id']['email'],
-                 'name':user['_id']['name'],
-                 'locale':user['_id']['locale'],
-                 'sites':user['sites']} for user in self.aggregate(pipeline)]
-
-    def normal(self):
+        # Aggregate the results with a cursor and yield the users
+        for user in self.aggregate(pipeline, batch_size):
+            yield {'email':user['_id']['email'],
+                   'name':user['_id']['name'],
+                   'locale':user['_id'].get('locale'),
+                   'sites':user['sites']}
+
+    def normal(self, batch_size=1000):
         """
         Get all normal users, a normal user is a user who is not an admin and
-        has not been muted by an administrator.
+        has not been muted by an administrator. Only the fields needed for
+        emails (email, name and locale) are fetched.
         """
-        # This is just a simple filter on top of the all function
-        return self.all(filters={'admin':False, 'mute':{'$ne':True}})
+        # This is just a simple filter on top of the all function (sorted
+        # by locale so emails in the same language can be rendered together)
+        return self.all(filters={'admin':False, 'mute':{'$ne':True}},
+                        fields=['name', 'locale'], sort=[('locale', 1)],
+                        batch_size=batch_size)
 
     def urls(self):
         """
@@ -133,30 +166,61 @@ class Users(MongoCollection):
         results = self.aggregate(pipeline)
         return results[0]['sites'] if len(results) else []
 
-    def have_url(self, url):
+    def watchers(self, sites, batch_size=1000):
         """
-        Get all users that are following a site identified with the given url.
-        These users must also be non-muted since we don't care about muted
-        users.
+        Get the users watching each of the given sites (only non-muted users)
+        with one aggregation per batch_size sites instead of a query per
+        site.
+
+        Output is a dictionary where the site url is the key and the value
+        is a list of dictionaries with the id, email, name and locale of
+        each user watching the site
         """
-        # Simple wrapper around a call to all
-        return self.all({'sites.url':site, 'mute':{'$ne':True}})
 
-    def touch(self, site):
+        watchers = {}
+        for chunk in chunks(sites, batch_size):
+            pipeline = [{'$match': {'sites.url': {'$in': chunk},
+                                    'mute': {'$ne': True}}},
+                        {'$unwind': '$sites'},
+                        {'$match': {'sites.url': {'$in': chunk}}},
+                        {'$group': {'_id': '$sites.url',
+                                    'users': {'$addToSet': {
+                                        'id': '$_id', 'email': '$username',
+                                        'name': '$name',
+                                        'locale': '$locale'}}}
+                         }]
+            for r in self.aggregate(pipeline):
+                watchers[r['_id']] = r['users']
+
+        return watchers
+
+    def touch(self, sites):
         """
         No this is not named so because we're trying to be funny about the
         python convention of 'self'. This is a reference to the *nix command
-        touch. This updates the last_changed variable for the site for all 
-        users.
+        touch. This updates the last_changed variable of the given sites for
+        all users.
         """
 
-        # We set multi to true since there might be many users for the same
-        # site (but we don't update users that have been muted)
-        self.collection.update({'sites.url': site, 'mute':{'$ne':True}}, 
-                               {'$set': {'sites.$.last_change':\
-                                             datetime.datetime.now()}}, 
-                               multi=True)
-
+        # The positional operator only updates the first matching site in
+        # a user's list of sites so we send an update for every site of
+        # every user watching it (all in one bulk operation) but we don't
+        # update users that have been muted
+        sites = list(sites)
+        now = datetime.datetime.now()
+        bulk = self.collection.initialize_unordered_bulk_op()
+        updates = 0
+        for user in self.collection.find({'sites.url': {'$in': sites},
+                                          'mute': {'$ne': True}},
+                                         fields=['sites.url']):
+            watched = set(s.get('url') for s in user.get('sites', []))
+            for site in watched.intersection(sites):
+                bulk.find({'_id': user['_id'], 'sites.url': site}).update(
+                    {'$set': {'sites.$.last_change': now}})
+                updates += 1
+
+        if updates:
+            bulk.execute()
 
 class Checksums(MongoCollection):
     """
@@ -166,40 +230,534 @@ class Checksums(MongoCollection):
 
     __collection__ = 'checksums'
 
-    def all(self):
+    @staticmethod
+    def values(checksum, etag=None, last_modified=None):
         """
-        Get all checksums of all sites in the collection
+        Get the values to set for a checksum (ETag and Last-Modified are
+        only set if provided so stored values aren't wiped out)
         """
+        values = {'checksum': checksum}
+        if etag:
+            values['etag'] = etag
+        if last_modified:
+            values['last_modified'] = last_modified
+        return values
+
+    def update_many(self, resources, batch_size=1000):
+        """
+        Update the checksums of many resources (dictionaries with site, url,
+        checksum and optionally etag and last_modified). The updates are
+        sent as unordered bulk upserts of batch_size resources each instead
+        of one round trip per resource.
+        """
+
+        # The upserts look up the site and url so they need an index
+        self.collection.ensure_index([('site', 1), ('url', 1)])
 
-        # We use the aggregation framework to get all checksums for the sites
-        pipeline = [{'$group': {'_id': '$site',
-                                'checksums': {'$push': '$checksum'}}
+        for chunk in chunks(resources, batch_size):
+            bulk = self.collection.initialize_unordered_bulk_op()
+            for r in chunk:
+                values = self.values(r['checksum'], r.get('etag'),
+                                      r.get('last_modified'))
+                bulk.find({'site': r['site'], 'url': r['url']}).upsert()\
+                    .update_one({'$set': values})
+            bulk.execute()
+
+    def remove_many(self, checksums, batch_size=1000):
+        """
+        Remove the urls with the given checksums for many sites (checksums
+        is a dictionary with sites as keys and lists of checksums as values).
+        The removals are sent as unordered bulk deletes of batch_size sites
+        each
+        """
+
+        for chunk in chunks(checksums.iteritems(), batch_size):
+            bulk = self.collection.initialize_unordered_bulk_op()
+            for (site, site_checksums) in chunk:
+                bulk.find({'site': site,
+                           'checksum': {'$in': list(site_checksums)}}).remove()
+            bulk.execute()
+
+    def remove_sites(self, sites, batch_size=1000):
+        """
+        Remove all checksums of the given sites (in batches of batch_size
+        sites)
+        """
+        for chunk in chunks(sites, batch_size):
+            self.collection.remove({'site': {'$in': chunk}})
+
+    def retain(self, sites):
+        """
+        Remove all checksums of sites that are not in the provided list of
+        sites (they are no longer being watched)
+        """
+        self.collection.remove({'site': {'$nin': sites}})
+
+class Checkpoints(MongoCollection):
+    """
+    The checkpoints collection stores the items processed by a shard of a
+    crawl run so an interrupted run can be resumed where it stopped
+    """
+
+    __collection__ = 'checkpoints'
+
+    def urls(self, run, shard):
+        """
+        Get the urls of the resources processed by a shard of a crawl run
+        """
+        return [i['url'] for i in self.collection.find(
+                {'run': run, 'shard': shard}, fields=['url'])]
+
+    def clear(self, run, shard):
+        """
+        Remove the checkpoint of a shard of a crawl run
+        """
+        self.collection.remove({'run': run, 'shard': shard})
+
+class Crawls(MongoCollection):
+    """
+    The crawls collection keeps track of crawls that are split into shards
+    (each crawled by a separate job). It stores the finished shards and the
+    sites that have changed so notifications can be sent once all of the
+    shards have finished.
+    """
+
+    __collection__ = 'crawls'
+
+    def add_changes(self, run, sites):
+        """
+        Add sites that have changed to a crawl run
+        """
+        self.collection.update({'_id': run},
+                               {'$addToSet': {'changes': {'$each': sites}}},
+                               upsert=True)
+
+    def finish(self, run, shard, shards):
+        """
+        Mark a shard of a crawl run as finished. Returns True if all shards
+        of the run have finished and the changes haven't been merged yet
+        """
+        crawl = self.collection.find_and_modify(
+            query={'_id': run},
+            update={'$addToSet': {'finished': shard},
+                    '$set': {'shards': shards}},
+            upsert=True, new=True)
+        return len(crawl['finished']) >= shards and not crawl.get('merged')
+
+    def finished(self, run, shard):
+        """
+        Check if a shard of a crawl run has already finished
+        """
+        return self.collection.find_one({'_id': run,
+                                         'finished': shard}) is not None
+
+    def merge(self, run):
+        """
+        Mark a crawl run as merged and return the sites that changed during
+        the run. Returns None if the run has already been merged (so we
+        won't send notifications twice)
+        """
+        crawl = self.collection.find_and_modify(
+            query={'_id': run, 'merged': {'$ne': True}},
+            update={'$set': {'merged': True}})
+        return crawl.get('changes', []) if crawl else None
+
+class CrawlRuns(MongoCollection):
+    """
+    The crawl runs collection stores the telemetry of every resource crawled
+    in a run (latency, size, status, redirects, links, hashing time) so we
+    can see where the crawl time goes
+    """
+
+    __collection__ = 'crawl_runs'
+
+    def runs(self):
+        """
+        Get the ids of all runs, latest first
+        """
+        return sorted(self.collection.distinct('run'), reverse=True)
+
+    def hosts(self, run):
+        """
+        Get the telemetry of a run summarised per host (number of resources,
+        average and total latency, bytes, hashing time and errors, which are
+        http errors and failed downloads)
+        """
+
+        pipeline = [{'$match': {'run': run}},
+                    {'$group': {'_id': '$host',
+                                'resources': {'$sum': 1},
+                                'latency': {'$avg': '$latency'},
+                                'total_latency': {'$sum': '$latency'},
+                                'bytes': {'$sum': '$bytes'},
+                                'hash_time': {'$sum': '$hash_time'},
+                                'errors': {'$sum': {'$cond': [
+                                    {'$or': [{'$gte': ['$status', 400]},
+                                             {'$gt': ['$error', None]}]},
+                                    1, 0]}}}
                      }]
 
-        # Create a dictionary where the site url is the key with a set of
-        # all checksums for that site as the value
-        return {r['_id']:set(r['checksums']) for r in self.aggregate(pipeline)}
+        return {r.pop('_id'):r for r in self.aggregate(pipeline)}
+
+    def largest(self, run, limit=10):
+        """
+        Get the largest resources of a run
+        """
+        return list(self.collection.find({'run': run}).sort(
+                'bytes', -1).limit(limit))
+
+class Snapshots(MongoCollection):
+    """
+    The snapshots collection stores the bodies of changed resources,
+    compressed with zlib and keyed by their digest so identical bodies
+    (across sites and crawls) are only stored once. The history of the
+    digests of each resource (site and url) is stored in the
+    snapshot_history collection so we can see what changed.
+    """
+
+    __collection__ = 'snapshots'
+
+    def __enter__(self):
+        """
+        Connect to the snapshot history collection as well
+        """
+        super(Snapshots, self).__enter__()
+        self.history = self.connection[self.database]['snapshot_history']
+        return self
+
+    def add(self, snapshots, keep=10):
+        """
+        Add snapshots of resources (dictionaries with site, url, digest and
+        the compressed body as snapshot). Bodies that are already stored
+        aren't stored again. Only the keep latest digests are kept in the
+        history of each resource.
+        """
+
+        if not snapshots:
+            return
+
+        self.history.ensure_index([('site', 1), ('url', 1)])
+
+        now = datetime.datetime.now()
+        bodies = self.collection.initialize_unordered_bulk_op()
+        history = self.history.initialize_unordered_bulk_op()
+
+        # Each body is only sent once even if many resources have it
+        for (digest, snapshot) in {s['digest']: s['snapshot']
+                                   for s in snapshots}.iteritems():
+            bodies.find({'_id': digest}).upsert().update_one({
+                    '$setOnInsert': {'body': Binary(snapshot),
+                                     'size': len(snapshot)},
+                    '$set': {'last_seen': now}})
+
+        for s in snapshots:
+            history.find({'site': s['site'], 'url': s['url']}).upsert()\
+                .update_one({'$push': {'digests': {
+                                '$each': [{'digest': s['digest'],
+                                           'time': now}],
+                                '$sort': {'time': 1}, '$slice': -keep}}})
+
+        bodies.execute()
+        history.execute()
 
-    def update(self, site, url, checksum):
+    def digests(self, site, url):
         """
-        Update a checksum as the value for a site, url combination in the
-        database collection.
+        Get the history of a resource as a list of dictionaries with the
+        digest and the time it was stored (oldest first)
         """
+        history = self.history.find_one({'site': site, 'url': url})
+        return history['digests'] if history else []
 
-        # The reason we use findAndModify is that it returns the old
-        # document. This means that if we want to check if this is a
-        # new insertion the result will be None and not None if it's an
-        # update to an existing document
-        return self.collection.find_and_modify(query={'site':site, 'url': url},
-                                               update={'checksum': checksum},
-                                               upsert=True)
+    def body(self, digest):
+        """
+        Get the (decompressed) body with the given digest or None if it
+        isn't stored
+        """
+        snapshot = self.collection.find_one({'_id': digest})
+        return zlib.decompress(snapshot['body']) if snapshot else None
+
+    def diff(self, site, url):
+        """
+        Get a unified diff (list of lines) between the two latest snapshots
+        of a resource. Returns an empty list if there aren't two snapshots
+        """
 
-    def remove(self, site, checksums):
+        digests = self.digests(site, url)[-2:]
+        if len(digests) < 2:
+            return []
+
+        (old, new) = [self.body(d['digest']) or '' for d in digests]
+        return list(difflib.unified_diff(
+                old.splitlines(), new.splitlines(),
+                digests[0]['time'].isoformat(), digests[1]['time'].isoformat(),
+                lineterm=''))
+
+    def prune(self, days):
+        """
+        Remove snapshots older than the given number of days. The latest
+        snapshot of each resource is always kept and bodies are only
+        removed if no history refers to them
         """
-        Remove any url for a given site that has a checksum which is in
-        the provided checksum list. 
+
+        cutoff = datetime.datetime.now() - datetime.timedelta(days=days)
+
+        # Histories are sorted so we only look at those with an old first
+        # digest and keep the recent digests (or at least the latest one)
+        bulk = self.history.initialize_unordered_bulk_op()
+        pruned = False
+        for history in self.history.find({'digests.0.time': {'$lt': cutoff}}):
+            digests = [d for d in history['digests'] if d['time'] >= cutoff]
+            bulk.find({'_id': history['_id']}).update_one(
+                {'$set': {'digests': digests or history['digests'][-1:]}})
+            pruned = True
+        if pruned:
+            bulk.execute()
+
+        # Bodies that haven't been stored since the cutoff are removed
+        # unless they're still in a history
+        old = (s['_id'] for s in self.collection.find(
+                {'last_seen': {'$lt': cutoff}}, fields=['_id']))
+        for chunk in chunks(old, 1000):
+            used = set(self.history.find({'digests.digest': {'$in': chunk}})\
+                           .distinct('digests.digest'))
+            unused = [digest for digest in chunk if digest not in used]
+            if unused:
+                self.collection.remove({'_id': {'$in': unused}})
+
+class Outbox(MongoCollection):
+    """
+    The outbox collection stores rendered emails until they have been
+    delivered. Each email has a key (e.g. user, template and period) so the
+    same email is never added twice and emails that couldn't be delivered
+    are retried later with an exponential backoff.
+    """
+
+    __collection__ = 'outbox'
+
+    def __enter__(self):
+        """
+        Make sure emails that are due can be found quickly and connect to
+        the collection with the delivery lock
+        """
+        super(Outbox, self).__enter__()
+        self.collection.ensure_index([('status', 1), ('retry', 1)])
+        self.locks = self.connection[self.database]['outbox_lock']
+        return self
+
+    def lock(self, owner, lease=600):
+        """
+        Take (or renew) the delivery lock for an owner for lease seconds.
+        Only one delivery can hold the lock so the MAIL_RATE limit of its
+        dispatcher holds for all emails. Returns True if the owner holds the
+        lock (a lock that hasn't been renewed in time can be taken over)
+        """
+
+        now = datetime.datetime.now()
+        try:
+            self.locks.find_and_modify(
+                query={'_id': 'delivery',
+                       '$or': [{'owner': owner}, {'until': {'$lt': now}}]},
+                update={'$set': {'owner': owner, 'until': now +
+                                 datetime.timedelta(seconds=lease)}},
+                upsert=True)
+        except OperationFailure:
+            # The lock is held by someone else (so it can't be inserted)
+            return False
+        return True
+
+    def unlock(self, owner):
+        """
+        Release the delivery lock (if the owner still holds it)
+        """
+        self.locks.remove({'_id': 'delivery', 'owner': owner})
+
+    def add(self, emails, batch_size=1000):
+        """
+        Add emails (dictionaries with key, to, content and html_content) to
+        the outbox. Emails whose key is already in the outbox are ignored.
+        Returns the number of emails that were added.
+        """
+
+        now = datetime.datetime.now()
+        added = 0
+        for chunk in chunks(emails, batch_size):
+            bulk = self.collection.initialize_unordered_bulk_op()
+            for email in chunk:
+                bulk.find({'_id': email['key']}).upsert().update_one({
+                        '$setOnInsert': {
+                            'to': email['to'], 'content': email['content'],
+                            'html_content': email.get('html_content'),
+                            'status': 'pending', 'attempts': 0,
+                            'created': now, 'retry': now}})
+            added += bulk.execute()['nUpserted']
+
+        return added
+
+    def claim(self, batch_size=100, lease=600):
         """
-        self.collection.remove({'site':site, 'checksum': {'$in': checksums}})
+        Claim up to batch_size pending emails that are due to be sent. The
+        claimed emails aren't claimed again until the lease (in seconds)
+        runs out so emails claimed by a worker that dies are retried
+        """
+
+        now = datetime.datetime.now()
+        token = ObjectId()
+
+        # Find emails that are due and claim the ones that haven't been
+        # claimed by someone else in the meantime
+        due = [e['_id'] for e in self.collection.find(
+                {'status': 'pending', 'retry': {'$lte': now}},
+                fields=['_id']).sort('retry', 1).limit(batch_size)]
+        if not due:
+            return []
+
+        self.collection.update(
+            {'_id': {'$in': due}, 'status': 'pending',
+             'retry': {'$lte': now}},
+            {'$set': {'claim': token,
+                      'retry': now + datetime.timedelta(seconds=lease)},
+             '$inc': {'attempts': 1}}, multi=True)
+        return list(self.collection.find({'claim': token}))
+
+    def sent(self, keys):
+        """
+        Mark emails as sent (the content is removed since we only keep the
+        keys so the emails won't be sent again)
+        """
+        if keys:
+            self.collection.update(
+                {'_id': {'$in': list(keys)}},
+                {'$set': {'status': 'sent',
+                          'sent': datetime.datetime.now()},
+                 '$unset': {'content': '', 'html_content': '', 'claim': ''}},
+                multi=True)
+
+    def failed(self, emails, backoff=60, attempts=8):
+        """
+        Schedule claimed emails that couldn't be delivered to be retried.
+        The wait (in seconds) is doubled after each attempt and emails
+        which have been attempted the given number of times are marked as
+        failed (and not retried)
+        """
+
+        if not emails:
+            return
+
+        now = datetime.datetime.now()
+        bulk = self.collection.initialize_unordered_bulk_op()
+        for email in emails:
+            if email['attempts'] >= attempts:
+                update = {'$set': {'status': 'failed'}}
+            else:
+                wait = backoff * 2 ** (email['attempts'] - 1)
+                update = {'$set': {'retry': now + datetime.timedelta(
+                            seconds=wait)}}
+            update['$unset'] = {'claim': ''}
+            bulk.find({'_id': email['_id']}).update_one(update)
+        bulk.execute()
+
+    def pending(self):
+        """
+        Get the number of emails that still have to be delivered
+        """
+        return self.collection.find({'status': 'pending'}).count()
+
+class Sites(MongoCollection):
+    """
+    The sites collection stores the change history of each crawled site:
+    when it was last crawled and changed, the observed intervals between
+    changes and the estimated change rate which is used to decide when the
+    site should be crawled next
+    """
+
+    __collection__ = 'sites'
+
+    def __init__(self, settings, *args, **kwargs):
+        """
+        Overwrite the MongoCollection __init__ to store settings in an instance
+        variable, self.settings
+        """
+
+        self.settings = settings
+        super(Sites,self).__init__(settings, *args, **kwargs)
+
+    def _interval(self, rate):
+        """
+        Get the number of days until a site with the given change rate
+        (changes per day) should be crawled again. Sites are crawled more
+        often than they change (CRAWL_INTERVAL_FACTOR) but never more often
+        than CRAWL_MIN_INTERVAL or less often than CRAWL_MAX_INTERVAL days
+        """
+        minimum = self.settings.getfloat('CRAWL_MIN_INTERVAL', 1)
+        maximum = self.settings.getfloat('CRAWL_MAX_INTERVAL', 30)
+        factor = self.settings.getfloat('CRAWL_INTERVAL_FACTOR', 0.5)
+
+        # Sites we know nothing about yet are crawled often to learn how
+        # often they change, sites that haven't changed rarely
+        if rate is None:
+            return minimum
+        if not rate:
+            return maximum
+        return min(maximum, max(minimum, factor / rate))
+
+    def history(self, crawled, changed, history):
+        """
+        Generate the updated history of each crawled site as (site, values)
+        tuples out of the stored history documents (the database isn't
+        touched so it can be used with any database access)
+        """
+
+        now = datetime.datetime.now()
+        changed = set(changed)
+        history = {s['_id']:s for s in history}
+
+        for site in crawled:
+            s = history.get(site, {'crawls': 0, 'changes': 0, 'days': 0.0,
+                                   'intervals': []})
+
+            # Each crawl after the first one tells us whether the site changed
+            # since the previous crawl and adds to the observed time (days)
+            if s.get('last_crawl'):
+                s['days'] += (now - s['last_crawl']).total_seconds() / 86400
+                s['crawls'] += 1
+                if site in changed:
+                    s['changes'] += 1
+            s['last_crawl'] = now
+
+            # We keep the last few intervals (in days) between changes
+            if site in changed:
+                if s.get('last_change'):
+                    interval = (now - s['last_change']).total_seconds() / 86400
+                    s['intervals'] = (s['intervals'] + [interval])[-10:]
+                s['last_change'] = now
+
+            # We only see if a site has changed between crawls, not how often
+            # so we use the estimator by Cho and Garcia-Molina which accounts
+            # for changes we missed between crawls
+            if s['crawls'] and s['days']:
+                s['rate'] = -math.log((s['crawls'] - s['changes'] + 0.5) /
+                                      (s['crawls'] + 0.5)) / \
+                                      (s['days'] / s['crawls'])
+            else:
+                s['rate'] = None
+
+            s['next_crawl'] = now + datetime.timedelta(
+                days=self._interval(s['rate']))
+
+            s.pop('_id', None)
+            yield (site, s)
+
+    def due(self, sites):
+        """
+        Get the sites (from a list of sites) that are due to be crawled,
+        i.e. their next crawl time has passed or they've never been crawled
+        """
+
+        now = datetime.datetime.now()
+        scheduled = set(s['_id'] for s in self.collection.find(
+                {'_id': {'$in': sites}, 'next_crawl': {'$gt': now}},
+                fields=['_id']))
+        return [site for site in sites if site not in scheduled]
 
 class Countries(MongoCollection):
     """
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+# beagle - scrape web resources for changes and notify users by email
+# Copyright (C) 2013  The Open Knowledge Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import txmongo
+from twisted.internet import defer, threads
+from pymongo.errors import OperationFailure
+from db.collections import Checksums, Sites
+
+class DeferredMongoCollection(object):
+    """
+    Twisted variant of MongoCollection (see db/mongo.py) built on txmongo.
+    All methods return Deferreds so the database can be used on the reactor
+    thread (e.g. in the scrapy pipeline) without blocking the crawl.
+
+    The connection is a lazy connection pool which is opened when it's first
+    used. Collections can share a connection by passing in the connection of
+    another collection but the collection that opened the connection has to
+    be disconnected when it's no longer needed:
+
+    checksums = DeferredChecksums(settingsobject)
+    sites = DeferredSites(settingsobject, checksums.connection)
+    # do something with checksums and sites
+    checksums.disconnect()
+    """
+
+    def __init__(self, settings, connection=None, *args, **kwargs):
+        """
+        Initialise the MongoDB connection with parameters from a settings
+        object with the same interface as to scrapy.settings.CrawlerSettings
+        """
+
+        # Connection parameters to the MongoDB database
+        self.host = settings.get('MONGODB_HOST', 'localhost')
+        self.port = settings.getint('MONGODB_PORT', 27017)
+        self.database = settings.get('MONGODB_DATABASE', 'beagle')
+        self.settings = settings
+
+        if connection is None:
+            connection = txmongo.lazyMongoConnectionPool(
+                self.host, self.port,
+                pool_size=settings.getint('MONGODB_POOL_SIZE', 5))
+        self.connection = connection
+        self.collection = self.connection[self.database][self._collection]
+
+    @property
+    def _collection(self):
+        """
+        The collection name, gathered from a subclass or the class name.
+        Subclasses should have an attribute '__collection__' with the
+        collection name
+        """
+        if hasattr(self, '__collection__'):
+            return self.__collection__
+        else:
+            return self.__class__.__name__.lower()
+
+    def disconnect(self):
+        """
+        Disconnect the MongoDB database connection
+        """
+        return self.connection.disconnect()
+
+    def _safe(self, deferred):
+        """
+        Check the result of a safe write. txmongo hands us the getlasterror
+        document without looking at it so a failed write would pass as a
+        successful one. Raises OperationFailure if the write failed
+        """
+
+        def check(result):
+            if isinstance(result, dict) and result.get('err'):
+                raise OperationFailure(result['err'], result.get('code'))
+            return result
+
+        return deferred.addCallback(check)
+
+    def _insert(self, documents):
+        """
+        Insert documents with a safe write. txmongo's insert replaces the
+        getlasterror document with the ids of the documents so we send the
+        insert and ask for the last error on the same connection ourselves
+        """
+        database = self.collection._database
+        proto = database._connection
+        proto.OP_INSERT(str(self.collection), documents)
+        return self._safe(database['$cmd'].find_one({'getlasterror': 1},
+                                                    _proto=proto))
+
+class DeferredChecksums(DeferredMongoCollection):
+    """
+    Twisted variant of the checksums collection (see db.collections)
+    """
+
+    __collection__ = 'checksums'
+
+    @defer.inlineCallbacks
+    def load(self, sites):
+        """
+        Get the (site, checksum) tuples of all checksums of the given sites
+        """
+        checksums = yield self.collection.find(
+            {'site': {'$in': sites}},
+            fields={'site': True, 'checksum': True, '_id': False})
+        defer.returnValue([(r['site'], r['checksum']) for r in checksums])
+
+    @defer.inlineCallbacks
+    def validators(self, sites):
+        """
+        Get the checksum along with the ETag and Last-Modified values (used
+        for conditional requests) for every url of the given sites.
+
+        Output is a dictionary where the site url is the key and the value
+        is a dictionary of resource urls and their stored values
+        """
+
+        validators = {}
+        resources = yield self.collection.find(
+            {'site': {'$in': sites}},
+            fields={'site': True, 'url': True, 'checksum': True,
+                    'etag': True, 'last_modified': True, '_id': False})
+        for r in resources:
+            validators.setdefault(r['site'], {})[r['url']] = {
+                'checksum': r['checksum'], 'etag': r.get('etag'),
+                'last_modified': r.get('last_modified')}
+
+        defer.returnValue(validators)
+
+    def sites(self, sites=None):
+        """
+        Get the sites that have checksums (or those of the provided list of
+        sites that have checksums)
+        """
+        spec = {'site': {'$in': sites}} if sites is not None else {}
+        return self.collection.distinct('site', spec)
+
+    def _bulk(self, method, *args):
+        """
+        Run a bulk write method of the pymongo checksums collection (see
+        db.collections) in a thread. txmongo has no bulk operations so this
+        lets us send unordered bulk writes instead of a round trip per
+        document without blocking the reactor
+        """
+
+        def write(settings):
+            with Checksums(settings) as checksums:
+                getattr(checksums, method)(*args)
+
+        return threads.deferToThread(write, self.settings)
+
+    def update_many(self, resources, batch_size=1000):
+        """
+        Update the checksums of many resources (dictionaries with site, url,
+        checksum and optionally etag and last_modified)
+        """
+        return self._bulk('update_many', list(resources), batch_size)
+
+    def remove_many(self, checksums, batch_size=1000):
+        """
+        Remove the urls with the given checksums for many sites (checksums
+        is a dictionary with sites as keys and lists of checksums as values)
+        """
+        return self._bulk('remove_many', checksums, batch_size)
+
+    def remove_sites(self, sites, batch_size=1000):
+        """
+        Remove all checksums of the given sites
+        """
+        return self._bulk('remove_sites', list(sites), batch_size)
+
+class DeferredCheckpoints(DeferredMongoCollection):
+    """
+    Twisted variant of the checkpoints collection (see db.collections)
+    """
+
+    __collection__ = 'checkpoints'
+
+    def add(self, run, shard, items):
+        """
+        Add processed items (dictionaries) to the checkpoint of a shard
+        """
+        return self._insert([dict(item, run=run, shard=shard)
+                             for item in items])
+
+    def items(self, run, shard):
+        """
+        Get the processed items of a shard of a crawl run
+        """
+        return self.collection.find({'run': run, 'shard': shard},
+                                    fields={'_id': False, 'run': False,
+                                            'shard': False})
+
+class DeferredCrawls(DeferredMongoCollection):
+    """
+    Twisted variant of the crawls collection (see db.collections)
+    """
+
+    __collection__ = 'crawls'
+
+    def add_changes(self, run, sites):
+        """
+        Add sites that have changed to a crawl run
+        """
+        return self._safe(self.collection.update(
+            {'_id': run}, {'$addToSet': {'changes': {'$each': sites}}},
+            upsert=True, safe=True))
+
+class DeferredCrawlRuns(DeferredMongoCollection):
+    """
+    Twisted variant of the crawl runs collection (see db.collections)
+    """
+
+    __collection__ = 'crawl_runs'
+
+    def add(self, run, shard, resources):
+        """
+        Add the telemetry of crawled resources (dictionaries) to a run
+        """
+        if not resources:
+            return defer.succeed(None)
+        return self._insert([dict(r, run=run, shard=shard)
+                             for r in resources])
+
+class DeferredSites(DeferredMongoCollection):
+    """
+    Twisted variant of the sites collection (see db.collections)
+    """
+
+    __collection__ = 'sites'
+
+    def __init__(self, settings, *args, **kwargs):
+        """
+        Keep a (not connected) sites collection around to compute the
+        history of the sites
+        """
+        self.sites = Sites(settings)
+        super(DeferredSites, self).__init__(settings, *args, **kwargs)
+
+    @defer.inlineCallbacks
+    def record(self, crawled, changed):
+        """
+        Record a crawl of sites (crawled is a list of crawled sites and
+        changed a list of those which changed) and update the estimated
+        change rate and the time of the next crawl for each of them
+        """
+
+        history = yield self.collection.find({'_id': {'$in': list(crawled)}})
+        yield defer.gatherResults(
+            [self._safe(self.collection.update({'_id': site}, {'$set': s},
+                                               upsert=True, safe=True))
+             for (site, s) in self.sites.history(crawled, changed, history)],
+            consumeErrors=True)
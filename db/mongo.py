@@ -73,14 +73,20 @@ class MongoCollection(object):
         """
         self.connection.disconnect()
 
-    def aggregate(self, pipeline):
+    def aggregate(self, pipeline, batch_size=None):
         """
         Short hand to the aggregate of the database class
         (which is a shorthand for the real aggregation function)
         Difference is that this one knows which collection we're accessing
         This mostly only saves use the self.collection part when called from
-        other functions
+        other functions. If a batch_size is given the results are read with
+        a cursor (batch_size at a time) instead of in one document
         """
 
+        # Return a cursor over the results
+        if batch_size is not None:
+            return self.collection.aggregate(pipeline,
+                                             cursor={'batchSize': batch_size})
+
         # Return the results (well the result of the results).
         return self.collection.aggregate(pipeline)['result']
@@ -16,10 +16,17 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from scrapy.settings import CrawlerSettings
-from db.collections import Users
-from beaglemail import sender, template
+from db.collections import Users, Outbox
+from beaglemail import template
+from beaglemail.dispatch import Dispatcher
 from babel.dates import format_date
+from redis.exceptions import ConnectionError
+from rq import Queue
+from worker import conn
+from hashlib import md5
 import datetime
+import itertools
+import uuid
 
 # We reuse the email settings from beagleboy
 import beagleboy.settings
@@ -34,25 +41,40 @@ def budget_reminder():
     # We piggyback on the beagleboy settings by loading and using them
     settings = CrawlerSettings(beagleboy.settings)
 
-    # Get users we want to send emails to and create the emailer
-    emailer = sender.Emailer(settings)
-    with Users(settings) as users:
+    # Reminders are sent every week of the grace period so the week is a
+    # part of the key of the email (we only send one each week)
+    week = '%d-W%02d' % datetime.date.today().isocalendar()[:2]
+
+    def messages(remindees):
         # Loop through each user and compose an email to that user
-        for user in users.remindees():
+        for user in remindees:
+            # In digest mode users get one email with all of their sites
+            # (users with only one site get the normal reminder)
+            if settings.getbool('MAIL_DIGESTS') and len(user['sites']) > 1:
+                params = {'researcher':user['name'],
+                          'sites':sorted(user['sites'],
+                                         key=lambda s: s['date'])}
+                yield ('budget_reminder_digest.email',
+                       u'%s/budget_reminder_digest/%s' % (user['email'],
+                                                          week),
+                       user, params)
+                continue
+
             # Loop through sites the user is tracking and create plain
             for site in user['sites']:
                 # The template needs site title and expected publication date
                 params = {'researcher':user['name'],
                           'date':site['date'],
                           'site':site['title']}
-                # We set html to True because we want both plain and html
-                (plain, html) = template.render('budget_reminder.email',
-                                                params, 
-                                                user.get('locale', None),
-                                                html=True)
+                yield ('budget_reminder.email',
+                       u'%s/budget_reminder/%s/%s' % (user['email'],
+                                                      site['title'], week),
+                       user, params)
 
-                # Send the email with our emailer
-                emailer.send(user['email'], plain, html_content=html)
+    # Get users we want to send emails to and add the emails to the outbox
+    # (they're delivered by separate jobs) as they're rendered
+    with Users(settings) as users:
+        return outbox(emails(messages(users.remindees())), settings)
 
 def report_reminder(when=None):
     """
@@ -64,12 +86,14 @@ def report_reminder(when=None):
     # We piggyback on the beagleboy settings by loading and using them
     settings = CrawlerSettings(beagleboy.settings)
 
-    # Get users we want to send emails to and create the emailer
-    emailer = sender.Emailer(settings)
+    # The due date is a part of the key of the emails (babel formats today
+    # if no date is given so we do the same)
+    if when is None:
+        when = datetime.date.today()
 
-    with Users(settings) as users:
+    def messages(normal):
         # Loop through each user and compose and email to that user
-        for user in users.normal():
+        for user in normal:
             # The template needs the researcher name and when report is due
             # and format the date here to make use of babel's date translations
             # we default to english as the locale if none is found. Note that
@@ -79,13 +103,16 @@ def report_reminder(when=None):
                       'date':format_date(when, format='long',
                                          locale=user.get('locale', 'en'))
                       }
-            # We set html to True because we want both plain and html
-            (plain, html) = template.render('report_reminder.email', params,
-                                            user.get('locale', None),
-                                            html=True)
-            
-            # Send the email with our emailer
-            emailer.send(user['email'], plain, html_content=html)
+            # There's one reminder for each report (due date)
+            yield ('report_reminder.email',
+                   u'%s/report_reminder/%s' % (user['email'],
+                                               when.isoformat()),
+                   user, params)
+
+    # Get users we want to send emails to and add the emails to the outbox
+    # (they're delivered by separate jobs) as they're rendered
+    with Users(settings) as users:
+        return outbox(emails(messages(users.normal())), settings)
 
 def report_due():
     """
@@ -95,27 +122,196 @@ def report_due():
     # We piggyback on the beagleboy settings by loading and using them
     settings = CrawlerSettings(beagleboy.settings)
 
-    # Get users we want to send emails to and create the emailer
-    emailer = sender.Emailer(settings)
+    # The template needs the researcher name and when the month the
+    # report is about, which is last month
+    today = datetime.date.today()
+    month_ago = today-datetime.timedelta(days=today.day)
 
-    with Users(settings) as users:
-        for user in users.normal():
-            # The template needs the researcher name and when the month the
-            # report is about, which is last month
-            today = datetime.date.today()
-            month_ago = today-datetime.timedelta(days=today.day)
+    def messages(normal):
+        for user in normal:
             params = {'researcher':user['name'],
                       'month': format_date(month_ago, 'MMMM',
                                            locale=user.get('locale', 'en'))
                       }
-            
-            # We set html to True because we want both plain and html
-            (plain, html) = template.render('report_due.email', params,
-                                            user.get('locale', None),
-                                            html=True)
-            
-            # Send the email with our emailer
-            emailer.send(user['email'], plain, html_content=html)
+            # There's one notification for each month
+            yield ('report_due.email',
+                   u'%s/report_due/%s' % (user['email'],
+                                          month_ago.strftime('%Y-%m')),
+                   user, params)
+
+    # Get users we want to send emails to and add the emails to the outbox
+    # (they're delivered by separate jobs) as they're rendered
+    with Users(settings) as users:
+        return outbox(emails(messages(users.normal())), settings)
+
+def change_notification(sites, settings=None):
+    """
+    Send out a notification to all users watching sites that have changed
+    and update the time of the last change for those sites. The settings
+    default to the beagleboy settings (but the spider passes in its own)
+    """
+
+    # We piggyback on the beagleboy settings by loading and using them
+    if settings is None:
+        settings = CrawlerSettings(beagleboy.settings)
+
+    # Users are notified about changes to a site at most once a day
+    today = datetime.date.today().isoformat()
+
+    def messages(watched):
+        for (user, changed) in watched:
+            # In digest mode users get one email with all of the sites that
+            # have changed (the key includes the sites since the same user
+            # can get a digest of other sites from another crawl that day)
+            if settings.getbool('MAIL_DIGESTS') and len(changed) > 1:
+                changed.sort()
+                params = {'researcher':user['name'], 'docurls':changed,
+                          'appurl':settings.get('FORM_URL', '')}
+                digest = md5(u'\n'.join(changed).encode('utf-8')).hexdigest()
+                yield ('scraper_digest.email',
+                       u'%s/scraper_digest/%s/%s' % (user['email'], today,
+                                                     digest),
+                       user, params)
+                continue
+
+            # Send an email to the user for each site that has changed
+            for site in changed:
+                # The scraper email uses docurl for the site url and 
+                # appurl to show where the form is
+                params = {'researcher':user['name'], 'docurl':site,
+                          'appurl':settings.get('FORM_URL', '')}
+                yield ('scraper.email',
+                       u'%s/scraper/%s/%s' % (user['email'], site, today),
+                       user, params)
+
+    # We loop through the sites that have been changed to
+    # send emails to the user watching them and update its time.
+    with Users(settings) as users:
+        # Get the users watching the changed sites in one go and group the
+        # changed sites by user
+        watchers = users.watchers(list(set(sites)))
+        watched = {}
+        for (site, watching) in watchers.iteritems():
+            for user in watching:
+                watched.setdefault(user['email'], (user, []))[1].append(site)
+
+        # Update the last_changed for the sites in the users' lists of sites
+        users.touch(watchers.keys())
+
+    # Render the emails of users with the same locale together
+    watched = sorted(watched.itervalues(), key=lambda w: w[0].get('locale'))
+    return outbox(emails(messages(watched)), settings)
+
+def emails(messages):
+    """
+    Render the emails of (template, key, user, params) messages and yield
+    them as they're rendered. Messages of users with the same locale
+    should come in a row (so their templates are rendered together)
+    """
+
+    for (path, group) in itertools.groupby(messages, lambda m: m[0]):
+        # We need the messages for the rendering and for the recipients
+        (group, records) = itertools.tee(group)
+        rendered = template.render_batch(
+            path, ((user.get('locale', None), params)
+                   for (path, key, user, params) in records), html=True)
+        for ((path, key, user, params), (plain, html)) in \
+                itertools.izip(group, rendered):
+            yield {'key': key, 'to': user['email'], 'content': plain,
+                   'html_content': html}
+
+def outbox(emails, settings):
+    """
+    Add emails to the outbox and queue jobs to deliver them. Emails that
+    are already in the outbox (same key) aren't added again so a job that
+    is retried won't send the same emails twice. Returns the number of
+    emails added to the outbox.
+    """
+
+    with Outbox(settings) as box:
+        queued = box.add(emails)
+
+    if queued:
+        queue_delivery(settings)
+
+    return {'queued': queued}
+
+def queue_delivery(settings):
+    """
+    Queue a job to deliver the emails in the outbox (unless
+    MAIL_QUEUE_DELIVERY is off). The connection is passed explicitly since
+    this can be called from a thread (rq's connection stack is per thread).
+    If the queue can't be reached the emails are delivered right away.
+    """
+
+    if settings.getbool('MAIL_QUEUE_DELIVERY', True):
+        try:
+            Queue(connection=conn).enqueue(deliver)
+            return
+        except ConnectionError:
+            pass
+
+    deliver(settings)
+
+def deliver(settings=None):
+    """
+    Deliver the emails in the outbox that are due. Emails are claimed in
+    batches and sent with the dispatcher. Emails that couldn't be
+    delivered are retried later (the wait is doubled after each attempt),
+    by a later job since the outbox is also drained on a schedule.
+
+    Only one delivery runs at a time (it holds a lock which is renewed for
+    every batch) so MAIL_RATE is the limit for all emails. If another
+    delivery is running this does nothing since that one sends the emails.
+    """
+
+    # We piggyback on the beagleboy settings by loading and using them
+    if settings is None:
+        settings = CrawlerSettings(beagleboy.settings)
+
+    batch_size = settings.getint('MAIL_OUTBOX_BATCH_SIZE', 100)
+    lease = settings.getint('MAIL_OUTBOX_LEASE', 600)
+    backoff = settings.getint('MAIL_RETRY_BACKOFF', 60)
+    attempts = settings.getint('MAIL_RETRY_ATTEMPTS', 8)
+
+    owner = uuid.uuid4().hex
+    dispatcher = Dispatcher(settings)
+    with Outbox(settings) as box:
+        if not box.lock(owner, lease):
+            return {'sent': 0, 'failed': 0}
+
+        try:
+            with dispatcher:
+                _drain(box, dispatcher, owner, batch_size, lease, backoff,
+                       attempts)
+        finally:
+            box.unlock(owner)
+
+    # Report how many emails were sent and how many failed
+    return {'sent': dispatcher.sent, 'failed': dispatcher.failed}
+
+def _drain(box, dispatcher, owner, batch_size, lease, backoff, attempts):
+    """
+    Send the emails of the outbox in batches while we hold the lock
+    """
+
+    while box.lock(owner, lease):
+        emails = box.claim(batch_size, lease)
+        if not emails:
+            return
+
+        for email in emails:
+            dispatcher.send(email['to'], email['content'],
+                            html_content=email['html_content'],
+                            key=email['_id'])
+
+        # Mark the batch in the outbox once it has been sent so a
+        # worker that dies only resends the emails of one batch
+        (delivered, failures) = dispatcher.flush()
+        box.sent(delivered)
+        failed = set(key for (key, error) in failures)
+        box.failed([e for e in emails if e['_id'] in failed],
+                   backoff, attempts)
 
 if __name__ == '__main__':
     report_due()
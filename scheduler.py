@@ -15,28 +15,75 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import datetime
+
 from apscheduler.scheduler import Scheduler
+from scrapy.settings import CrawlerSettings
 
 from rq import Queue
 from worker import conn
 
 from crawler import crawl_webresources
-from reminder import budget_reminder, report_reminder
+from reminder import budget_reminder, report_reminder, report_due, deliver
 from loader import load_obi_scores
 from beagleboy import settings
+from beagleboy.sharding import shard_urls
+from db.collections import Users, Sites
 
 # Set up queue and scheduler
 q = Queue(connection=conn)
 sched = Scheduler()
 
 
+def enqueue_crawl(sites):
+    """
+    Split sites into shards (by host) and enqueue a crawl job for each shard
+    so the crawl can be spread over many workers
+    """
+
+    shards = shard_urls(sites, settings.CRAWL_SHARDS)
+
+    # Enqueue via Redis queue the web resource crawler for each shard. The
+    # run identifies this crawl (for merging the shards when they finish)
+    run = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+    for shard, shard_sites in enumerate(shards):
+        result = q.enqueue(crawl_webresources, shard_sites, run, shard,
+                           len(shards))
+
 @sched.cron_schedule(day='last')
 def crawl():
     """
     A scheduled method that runs the crawler on the last day of the month
+    (unless sites are crawled when they're due, see crawl_due)
+    """
+
+    if settings.CRAWL_SCHEDULE != 'monthly':
+        return
+
+    # Get all of the sites and crawl them
+    with Users(CrawlerSettings(settings)) as users:
+        enqueue_crawl(users.urls())
+
+@sched.cron_schedule(hour=2)
+def crawl_due():
+    """
+    A scheduled method that runs every night and crawls the sites that are
+    due to be crawled. Each site is crawled based on how often it changes
+    (sites that change often are crawled more often than stale ones)
     """
-    # Enqueue via Redis queue the web resource crawler
-    result = q.enqueue(crawl_webresources)
+
+    if settings.CRAWL_SCHEDULE != 'adaptive':
+        return
+
+    # Get all of the sites and crawl those which are due
+    crawler_settings = CrawlerSettings(settings)
+    with Users(crawler_settings) as users:
+        urls = users.urls()
+    with Sites(crawler_settings) as sites:
+        due = sites.due(urls)
+
+    if due:
+        enqueue_crawl(due)
 
 @sched.interval_schedule(weeks=1)
 def reminders():
@@ -94,6 +141,16 @@ def report_first_friday():
 
     result = q.enqueue(report_due)
 
+@sched.interval_schedule(minutes=10)
+def outbox():
+    """
+    A scheduled method that delivers emails left in the outbox. Emails are
+    delivered when they're added but the ones that couldn't be delivered
+    are retried here (once their backoff has passed)
+    """
+
+    result = q.enqueue(deliver)
+
 @sched.interval_schedule(weeks=4)
 def load_scores():
     """
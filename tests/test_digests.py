@@ -0,0 +1,63 @@
+# beagle - scrape web resources for changes and notify users by email
+# Copyright (C) 2013  The Open Knowledge Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+from hashlib import md5
+from beagleboy.digests import DigestSet
+
+def checksum(n):
+    return md5(str(n)).hexdigest()
+
+class TestDigestSet(unittest.TestCase):
+
+    def test_add_and_contains(self):
+        digests = DigestSet(checksum(n) for n in xrange(10))
+        self.assertEqual(len(digests), 10)
+        self.assertTrue(checksum(3) in digests)
+        self.assertFalse(checksum(10) in digests)
+        # Adding a checksum that's already there doesn't change the set
+        digests.add(checksum(3))
+        self.assertEqual(len(digests), 10)
+
+    def test_remove(self):
+        digests = DigestSet([checksum(1), checksum(2)])
+        digests.remove(checksum(1))
+        self.assertFalse(checksum(1) in digests)
+        self.assertEqual(list(digests), [checksum(2)])
+        digests.remove(checksum(2))
+        self.assertFalse(digests)
+
+    def test_remove_missing(self):
+        digests = DigestSet([checksum(1)])
+        self.assertRaises(KeyError, digests.remove, checksum(2))
+        try:
+            digests.remove(checksum(2))
+        except KeyError as error:
+            # The error has the checksum (like a set of checksums would)
+            self.assertEqual(error.args, (checksum(2),))
+
+    def test_iterate(self):
+        checksums = set(checksum(n) for n in xrange(100))
+        self.assertEqual(set(DigestSet(checksums)), checksums)
+
+    def test_simhash(self):
+        # SimHashes are 128 bit hexadecimal checksums too
+        digests = DigestSet(['%032x' % 1])
+        self.assertTrue('%032x' % 1 in digests)
+        self.assertFalse('%032x' % 2 in digests)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+# beagle - scrape web resources for changes and notify users by email
+# Copyright (C) 2013  The Open Knowledge Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+import unittest
+from beaglemail.dispatch import TokenBucket
+
+def timed(function, *args):
+    """
+    Get how many seconds a function call takes
+    """
+    started = time.time()
+    function(*args)
+    return time.time() - started
+
+def acquire(bucket, tokens):
+    for n in xrange(tokens):
+        bucket.acquire()
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_no_limit(self):
+        self.assertTrue(timed(acquire, TokenBucket(0), 10000) < 0.5)
+
+    def test_rate(self):
+        # The first token is there, the others come at 100 per second
+        elapsed = timed(acquire, TokenBucket(100), 21)
+        self.assertTrue(0.19 <= elapsed < 0.5)
+
+    def test_burst(self):
+        bucket = TokenBucket(10, burst=5)
+        self.assertTrue(timed(acquire, bucket, 5) < 0.05)
+        # The burst has been used up so the next token takes a tenth
+        self.assertTrue(timed(acquire, bucket, 1) >= 0.09)
+
+    def test_shared_between_threads(self):
+        # The rate holds for all threads together
+        bucket = TokenBucket(200)
+        threads = [threading.Thread(target=acquire, args=(bucket, 10))
+                   for n in xrange(4)]
+        started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(time.time() - started >= 0.19)
+
+if __name__ == '__main__':
+    unittest.main()
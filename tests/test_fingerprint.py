@@ -0,0 +1,129 @@
+# beagle - scrape web resources for changes and notify users by email
+# Copyright (C) 2013  The Open Knowledge Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+from scrapy.http import HtmlResponse, Request, Response
+from scrapy.settings import Settings
+from beagleboy.fingerprint import Fingerprinter, NormalizedFingerprinter, \
+    TIMESTAMPS, hamming
+
+def page(body, url='http://www.example.com/'):
+    """
+    Create an html response for a page (fingerprinters look at the meta so
+    the response needs a request)
+    """
+    return HtmlResponse(url, body=body, encoding='utf-8',
+                        request=Request(url))
+
+class TestHamming(unittest.TestCase):
+
+    def test_same(self):
+        self.assertEqual(hamming('0f' * 16, '0f' * 16), 0)
+
+    def test_bits(self):
+        self.assertEqual(hamming('00' * 16, '00' * 15 + '07'), 3)
+        self.assertEqual(hamming('ff' * 16, '00' * 16), 128)
+
+class TestFingerprinter(unittest.TestCase):
+
+    def test_raw_body(self):
+        fingerprinter = Fingerprinter(Settings())
+        self.assertNotEqual(fingerprinter.checksum(page('<p>a</p>')),
+                            fingerprinter.checksum(page('<p>a</p> ')))
+
+    def test_checksum_from_download(self):
+        # Resources hashed while they're downloaded keep their checksum
+        fingerprinter = Fingerprinter(Settings())
+        response = page('<p>a</p>')
+        response.meta['checksum'] = 'abc'
+        self.assertEqual(fingerprinter.checksum(response), 'abc')
+
+class TestNormalizedFingerprinter(unittest.TestCase):
+
+    def setUp(self):
+        self.fingerprinter = NormalizedFingerprinter(Settings())
+
+    def assertSame(self, a, b):
+        self.assertEqual(self.fingerprinter.checksum(page(a)),
+                         self.fingerprinter.checksum(page(b)))
+
+    def assertDifferent(self, a, b):
+        self.assertNotEqual(self.fingerprinter.checksum(page(a)),
+                            self.fingerprinter.checksum(page(b)))
+
+    def test_comments(self):
+        self.assertSame('<p>a</p><!-- generated 12:01 -->',
+                        '<p>a</p><!-- generated 12:02 -->')
+        # Conditional comments are kept
+        self.assertDifferent('<!--[if IE]><link href="a.css"><![endif]-->',
+                             '<!--[if IE]><link href="b.css"><![endif]-->')
+
+    def test_whitespace(self):
+        self.assertSame('<p>a  b</p>\n', '<p>a\n\tb</p>')
+        # Whitespace in preformatted text is content
+        self.assertDifferent('<pre>1  2</pre>', '<pre>1 2</pre>')
+
+    def test_volatile_attributes(self):
+        self.assertSame('<script nonce="abc">x</script>',
+                        '<script nonce="def">x</script>')
+        self.assertSame('<meta name="csrf-token" content="a" data-csrf="a">',
+                        '<meta name="csrf-token" content="a" data-csrf="b">')
+
+    def test_volatile_fields(self):
+        self.assertSame('<input type="hidden" name="csrf_token" value="a">',
+                        '<input type="hidden" name="csrf_token" value="b">')
+        self.assertDifferent('<input type="text" name="year" value="2013">',
+                             '<input type="text" name="year" value="2014">')
+
+    def test_link_parameters(self):
+        self.assertSame('<a href="budget.pdf?sid=1&amp;year=2014">Budget</a>',
+                        '<a href="budget.pdf?sid=2&amp;year=2014">Budget</a>')
+        self.assertSame('<img src="chart.png?_=1390000000">',
+                        '<img src="chart.png?_=1390000001">')
+        self.assertDifferent('<a href="budget.pdf?year=2013">Budget</a>',
+                             '<a href="budget.pdf?year=2014">Budget</a>')
+
+    def test_text_left_alone(self):
+        # Things that look like tokens or parameters in the text of the page
+        # are content (and so are numbers that look like timestamps)
+        self.assertDifferent('<p>token="a"</p>', '<p>token="b"</p>')
+        self.assertDifferent('<p>?sid=1</p>', '<p>?sid=2</p>')
+        self.assertDifferent('<p>Total: 1390000000</p>',
+                             '<p>Total: 1390000001</p>')
+
+    def test_ignore_rules(self):
+        fingerprinter = NormalizedFingerprinter(Settings({
+                    'FINGERPRINT_IGNORE': {'www.example.com': [
+                            r'Visitors: \d+', TIMESTAMPS]}}))
+        checksum = lambda body: fingerprinter.checksum(page(body))
+        self.assertEqual(checksum('<p>Visitors: 10</p>'),
+                         checksum('<p>Visitors: 11</p>'))
+        self.assertEqual(checksum('<script>var t=1390000000;</script>'),
+                         checksum('<script>var t=1390000001;</script>'))
+        # The rules only apply to their host
+        self.assertNotEqual(
+            fingerprinter.checksum(page('<p>Visitors: 10</p>',
+                                        'http://other.example.com/')),
+            fingerprinter.checksum(page('<p>Visitors: 11</p>',
+                                        'http://other.example.com/')))
+
+    def test_binary_untouched(self):
+        url = 'http://www.example.com/budget.pdf'
+        response = Response(url, body='a  b', request=Request(url))
+        self.assertEqual(self.fingerprinter.normalize(response), 'a  b')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+# beagle - scrape web resources for changes and notify users by email
+# Copyright (C) 2013  The Open Knowledge Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import pymongo
+from pymongo.errors import ConnectionFailure
+from scrapy.settings import Settings
+from db.collections import Outbox
+
+# The tests run against the beagle_test database on localhost
+SETTINGS = Settings({'MONGODB_DATABASE': 'beagle_test'})
+
+def email(key):
+    return {'key': key, 'to': '%s@example.com' % key, 'content': 'Hi'}
+
+class TestOutbox(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        try:
+            pymongo.MongoClient('localhost', 27017,
+                                connectTimeoutMS=500).disconnect()
+        except ConnectionFailure:
+            raise unittest.SkipTest('MongoDB is not running')
+
+    def setUp(self):
+        self.outbox = Outbox(SETTINGS).__enter__()
+        self.outbox.collection.remove()
+        self.outbox.locks.remove()
+
+    def tearDown(self):
+        self.outbox.collection.drop()
+        self.outbox.locks.drop()
+        self.outbox.__exit__(None, None, None)
+
+    def test_lock(self):
+        self.assertTrue(self.outbox.lock('a'))
+        self.assertFalse(self.outbox.lock('b'))
+        # The owner can renew the lock
+        self.assertTrue(self.outbox.lock('a'))
+        self.outbox.unlock('a')
+        self.assertTrue(self.outbox.lock('b'))
+
+    def test_unlock_only_owner(self):
+        self.assertTrue(self.outbox.lock('a'))
+        self.outbox.unlock('b')
+        self.assertFalse(self.outbox.lock('b'))
+
+    def test_lock_expired(self):
+        # A lock that hasn't been renewed in time can be taken over
+        self.assertTrue(self.outbox.lock('a', lease=-1))
+        self.assertTrue(self.outbox.lock('b'))
+        self.assertFalse(self.outbox.lock('a'))
+
+    def test_add_once(self):
+        self.assertEqual(self.outbox.add([email('a'), email('b')]), 2)
+        self.assertEqual(self.outbox.add([email('a'), email('c')]), 1)
+        self.assertEqual(self.outbox.pending(), 3)
+
+    def test_claim(self):
+        self.outbox.add([email(key) for key in 'abc'])
+        claimed = self.outbox.claim(batch_size=2)
+        self.assertEqual(len(claimed), 2)
+        self.assertTrue(all(e['attempts'] == 1 for e in claimed))
+        # Claimed emails aren't claimed again while the lease lasts
+        rest = self.outbox.claim(batch_size=2)
+        self.assertEqual([e['_id'] for e in rest],
+                         list(set('abc') - set(e['_id'] for e in claimed)))
+        self.assertEqual(self.outbox.claim(), [])
+
+    def test_claim_expired(self):
+        # Emails claimed by a delivery that died are claimed again
+        self.outbox.add([email('a')])
+        self.assertEqual(len(self.outbox.claim(lease=-1)), 1)
+        claimed = self.outbox.claim()
+        self.assertEqual([(e['_id'], e['attempts']) for e in claimed],
+                         [('a', 2)])
+
+    def test_sent_and_failed(self):
+        self.outbox.add([email(key) for key in 'abc'])
+        claimed = dict((e['_id'], e) for e in self.outbox.claim())
+        self.outbox.sent(['a'])
+        # b is retried later, c has been attempted too often
+        claimed['c']['attempts'] = 8
+        self.outbox.failed([claimed['b'], claimed['c']], backoff=60,
+                           attempts=8)
+        self.assertEqual(self.outbox.pending(), 1)
+        self.assertEqual(self.outbox.claim(), [])
+        statuses = dict((e['_id'], e['status'])
+                        for e in self.outbox.collection.find())
+        self.assertEqual(statuses, {'a': 'sent', 'b': 'pending',
+                                    'c': 'failed'})
+
+if __name__ == '__main__':
+    unittest.main()
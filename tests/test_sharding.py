@@ -0,0 +1,70 @@
+# beagle - scrape web resources for changes and notify users by email
+# Copyright (C) 2013  The Open Knowledge Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+from beagleboy.sharding import HashRing, shard_urls
+
+class TestHashRing(unittest.TestCase):
+
+    def test_deterministic(self):
+        # Separate processes (jobs) have to agree on the shard of a key
+        (a, b) = (HashRing(8), HashRing(8))
+        for n in xrange(100):
+            key = 'host%d.example.com' % n
+            self.assertEqual(a.shard(key), b.shard(key))
+
+    def test_all_shards_used(self):
+        ring = HashRing(4)
+        shards = [ring.shard('host%d.example.com' % n) for n in xrange(1000)]
+        self.assertEqual(set(shards), set(xrange(4)))
+        # The replicas spread the keys evenly (within a generous margin)
+        for shard in xrange(4):
+            self.assertTrue(150 < shards.count(shard) < 350)
+
+    def test_few_keys_move(self):
+        # Adding a shard only moves the keys the new shard takes over
+        keys = ['host%d.example.com' % n for n in xrange(1000)]
+        (before, after) = (HashRing(4), HashRing(5))
+        moved = [k for k in keys if before.shard(k) != after.shard(k)]
+        self.assertTrue(all(after.shard(k) == 4 for k in moved))
+        self.assertTrue(len(moved) < 350)
+
+    def test_unicode(self):
+        ring = HashRing(4)
+        self.assertEqual(ring.shard(u'h\xe9llo.example.com'),
+                         ring.shard(u'h\xe9llo.example.com'.encode('utf-8')))
+
+class TestShardUrls(unittest.TestCase):
+
+    def test_split_by_host(self):
+        urls = ['http://a.example.com/', 'http://b.example.com/',
+                'http://A.example.com/budget', 'https://a.example.com:8443/',
+                'http://c.example.com/']
+        shards = shard_urls(urls, 3)
+        self.assertEqual(len(shards), 3)
+        self.assertEqual(sorted(sum(shards, [])), sorted(urls))
+        # All urls of a host (case insensitive, any port or scheme) end up
+        # in the same shard
+        shard = [s for s in shards if urls[0] in s][0]
+        for url in urls[2:4]:
+            self.assertTrue(url in shard)
+
+    def test_one_shard(self):
+        urls = ['http://a.example.com/', 'http://b.example.com/']
+        self.assertEqual(shard_urls(urls, 1), [urls])
+
+if __name__ == '__main__':
+    unittest.main()
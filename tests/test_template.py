@@ -0,0 +1,65 @@
+# beagle - scrape web resources for changes and notify users by email
+# Copyright (C) 2013  The Open Knowledge Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+from beaglemail import template
+
+def params(researcher):
+    return {'researcher': researcher, 'docurl': 'http://www.example.com/',
+            'appurl': 'http://tracker.example.com/'}
+
+class TestRenderBatch(unittest.TestCase):
+
+    def test_same_as_render(self):
+        records = [(None, params('a')), (None, params('b')),
+                   ('es', params('c')), (None, params('d'))]
+        self.assertEqual(
+            list(template.render_batch('scraper.email', records)),
+            [template.render('scraper.email', p, locale)
+             for (locale, p) in records])
+
+    def test_html(self):
+        records = [(None, params('a')), ('fr', params('b'))]
+        rendered = list(template.render_batch('scraper.email', records,
+                                              html=True))
+        self.assertEqual(len(rendered), 2)
+        for ((plain, html), (locale, p)) in zip(rendered, records):
+            self.assertTrue(p['researcher'] in plain)
+            self.assertTrue(html.startswith(plain.split('\n')[0]))
+            self.assertTrue('<html>' in html and '<html>' not in plain)
+
+    def test_lazy(self):
+        # Records are rendered as they're read (so users can be streamed)
+        read = []
+        def records():
+            for researcher in 'abcd':
+                read.append(researcher)
+                yield (None, params(researcher))
+
+        batch = template.render_batch('scraper.email', records())
+        self.assertTrue('Dear a!' in next(batch))
+        self.assertTrue(len(read) <= 2)
+        self.assertEqual(len(list(batch)), 3)
+
+    def test_environment_per_locale(self):
+        # Templates of a locale are compiled once and reused
+        self.assertTrue(template.environment('es') is
+                        template.environment('es'))
+        self.assertFalse(template.environment('es') is
+                         template.environment('fr'))
+
+if __name__ == '__main__':
+    unittest.main()